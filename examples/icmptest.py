@@ -8,6 +8,7 @@ sys.path.insert(0, "..")
 
 from micor.handler import BaseHandler
 from micor import Future, coroutine, IOLoop, errors
+from micor.gen import with_timeout
 from micor.utils import ip_type
 from myss.resolver import resolver
 
@@ -29,11 +30,7 @@ class ICMPClient(BaseHandler):
         if not ip_type(dst):
             future =  resolver.getaddrinfo(dst, 0, proto=socket.IPPROTO_ICMP)
             start = time.time()
-            timer = self._loop.add_calllater(timeout,
-                    lambda: future.cancel((errors.TimeoutError, None, None))
-                )
-            res = yield future
-            self._loop.remove_timer(timer)
+            res = yield with_timeout(future, timeout, self._loop)
             timeout -= (time.time() - start)
             family, tp, proto, cn, sa = res[0]
         else:
@@ -43,11 +40,7 @@ class ICMPClient(BaseHandler):
         pkg = cares.build_ping_pkg(ts, 1, 1)
         self._sock.sendto(pkg, sa)
         
-        future = self.recvfrom()
-        timer = self._loop.add_calllater(
-            timeout,lambda: future.cancel((errors.TimeoutError, None, None)))
-        res, svr = yield future
-        self._loop.remove_timer(timer)
+        res, svr = yield with_timeout(self.recvfrom(), timeout, self._loop)
 
         frame = cares.parse_ping_pkg(res)
         rtt = time.time()*1000 - struct.unpack("!Q", frame.data)[0]
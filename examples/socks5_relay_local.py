@@ -8,7 +8,7 @@ logging.basicConfig(level=logging.DEBUG)
 
 sys.path.insert(0, ".")
 
-from micor import IOLoop, coroutine, TCPServer, UDPServer
+from micor import IOLoop, coroutine, TCPServer, UDPServer, fork_processes
 from myss.relay import SocksTCPLocalRelay, SocksUDPLocalRelay
 
 
@@ -27,7 +27,12 @@ class UDPRelayServer(UDPServer):
 
 
 if __name__ == "__main__":
-    
+
+    # number of worker processes, 0 for one per cpu
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if workers != 1:
+        fork_processes(workers)
+
     loop = IOLoop.current()
     tcp_server = TCPRelayServer(
         "0.0.0.0", 1080, 
@@ -0,0 +1,96 @@
+import sys, time
+sys.path.insert(0, "..")
+
+from micor.gen import Future, Task, coroutine
+from micor.ioloop import IOLoop
+
+
+def pending(waiters):
+    f = Future()
+    waiters.append(f)
+    return f
+
+
+def wake(waiters):
+    while waiters:
+        waiters.pop().set_result(1)
+
+
+@coroutine
+def gen_style(waiters, count):
+    n = 0
+    for i in range(count):
+        n += yield pending(waiters)
+    return n
+
+
+@coroutine
+async def async_style(waiters, count):
+    n = 0
+    for i in range(count):
+        n += await pending(waiters)
+    return n
+
+
+def lambda_step(gen, future, value=None):
+    """stepping of micor before Task, a closure per suspension"""
+    try:
+        fut = gen.send(value._result if value else None)
+        fut.add_done_callback(lambda value: lambda_step(gen, future, value))
+    except StopIteration as e:
+        future.set_result(e.value)
+
+
+def run(name, make, count):
+    waiters = []
+    start = time.time()
+    fut = make(waiters, count)
+    while not fut.done():
+        wake(waiters)
+    assert fut.result() == count
+    print("%-8s: %.3f" % (name, time.time() - start))
+
+
+def legacy(waiters, count):
+    future = Future()
+    lambda_step(gen_style.__wrapped__(waiters, count), future)
+    return future
+
+
+def done():
+    f = Future()
+    f.set_result(1)
+    return f
+
+
+@coroutine
+def buffered(count):
+    """waits only for futures which are done already, as reads of
+    buffered data and DNS cache hits do"""
+    n = 0
+    for i in range(count):
+        n += yield done()
+    return n
+
+
+def run_loop(name, eager_max, count):
+    """`eager_max` 1 resumes a task through the loop on every done future"""
+    Task.EAGER_MAX, saved = eager_max, Task.EAGER_MAX
+    loop = IOLoop()
+    loop.make_current()
+    start = time.time()
+    fut = buffered(count)
+    loop.add_future(fut, lambda f: loop.stop())
+    loop.run()
+    Task.EAGER_MAX = saved
+    assert fut.result() == count
+    print("%-8s: %.3f" % (name, time.time() - start))
+
+
+if __name__ == "__main__":
+    count = 1000000
+    run("lambda", legacy, count)
+    run("gen", gen_style, count)
+    run("async", async_style, count)
+    run_loop("loop", 1, count)
+    run_loop("eager", Task.EAGER_MAX, count)
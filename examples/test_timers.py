@@ -0,0 +1,45 @@
+import sys, time, random
+sys.path.insert(0, "..")
+
+from micor.ioloop import Timer, TimerHeap, TimingWheel
+
+
+def churn(impl, count, idle=100000):
+    """add a read timeout and cancel it, as every read of a connection does,
+    while `idle` connections keep their timeouts pending"""
+    timers = impl(0)
+    for i in range(idle):
+        timers.add(Timer(30 + random.random() * 60, None))
+    start = time.time()
+    for i in range(count):
+        t = Timer(60 + i * 1e-5, None)
+        timers.add(t)
+        timers.remove(t)
+        timers.pop_due(i * 1e-5, [])
+    return time.time() - start
+
+
+def expire(impl, count):
+    """add timers spread over 10 seconds, then run the clock until all fire"""
+    timers = impl(0)
+    start = time.time()
+    for i in range(count):
+        timers.add(Timer(random.random() * 10, lambda: None))
+    fired = []
+    now = 0
+    while len(fired) < count:
+        now += 0.001
+        timers.pop_due(now, fired)
+    return time.time() - start
+
+
+def best(bench, impl, count, repeat=5):
+    """fastest of `repeat` runs, a single run is too noisy to compare"""
+    return min(bench(impl, count) for i in range(repeat))
+
+
+if __name__ == "__main__":
+    count = 200000
+    for impl in (TimerHeap, TimingWheel):
+        print("%-12s churn : %.3f" % (impl.__name__, best(churn, impl, count)))
+        print("%-12s expire: %.3f" % (impl.__name__, best(expire, impl, count)))
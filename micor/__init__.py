@@ -1,5 +1,6 @@
-from .gen import coroutine, Future
-from .ioloop import IOLoop, Timer
+from .gen import coroutine, Future, Task, ensure_future
+from .ioloop import IOLoop, Timer, start_loop_threads
 from .handler import BaseHandler, Connection,\
     TCPClient, TCPServer, UDPServer, Datagram,\
-    UDPClient
\ No newline at end of file
+    UDPClient, shutdown
+from .process import fork_processes, task_id
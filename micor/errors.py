@@ -9,3 +9,7 @@ class ConnectionClosed(Exception):
         super().__init__()
         self.by = by
         self.reason = reason
+
+
+class UnsatisfiableReadError(Exception):
+    """delimiter is not found within the bytes a read is allowed to buffer"""
@@ -1,6 +1,6 @@
 import sys
 from functools import wraps
-from types import GeneratorType
+from types import GeneratorType, CoroutineType
 import traceback
 from . import errors
 
@@ -38,19 +38,29 @@ def print_exception(tp, val, tb):
     print(tpv, val, file=sys.stderr)
 
 class Future(object):
+    """result of an operation which completes later. any number of done
+    callbacks may be added, each is called once in order of adding, right
+    away if the future is done already. an exception nobody waited for
+    is printed when the future is collected, rather than when it's set,
+    as a waiter may still come and take it"""
 
     _PENDING = 0
     _RUNNING = 1
     _CANCELLED = 2
     _FINISHED = -1
 
-    __slots__ = ["_callback", "_exc_info", "_result", "_status"]
+    __slots__ = ["_callback", "_exc_info", "_result", "_status", "_log_exc"]
 
     def __init__(self):
-        self._callback = self.print_excinfo
+        self._callback = None       # a callback, or a list of callbacks
         self._exc_info = None
         self._result = None
         self._status = self._PENDING
+        self._log_exc = False       # exception raised but nobody waits for it
+
+    def __del__(self):
+        if self._log_exc:
+            self.print_excinfo()
 
     def print_excinfo(self, fut=None):
         fut = fut if fut else self
@@ -69,7 +79,24 @@ class Future(object):
         return self._status == self._FINISHED
 
     def add_done_callback(self, callback):
-        self._callback = callback
+        self._log_exc = False
+        if self.done():
+            callback(self)
+            return
+        cb = self._callback
+        if cb is None:
+            self._callback = callback
+        elif type(cb) is list:
+            cb.append(callback)
+        else:
+            self._callback = [cb, callback]
+
+    def remove_done_callback(self, callback):
+        cb = self._callback
+        if cb == callback:
+            self._callback = None
+        elif type(cb) is list and callback in cb:
+            cb.remove(callback)
 
     def result(self):
         return self._result
@@ -82,53 +109,187 @@ class Future(object):
         self._exc_info = exc_info
         self.set_done()
 
+    def __await__(self):
+        if not self.done():
+            yield self      # resumed by Task after this future is done
+        if self._exc_info:
+            tp, val, tb = self._exc_info
+            raise (val if val is not None else tp()).with_traceback(tb)
+        return self._result
+
+    __iter__ = __await__    # so that `yield from future` works as well
+
     def set_done(self):
 
         if self._status == self._FINISHED:
             del self
             return
-            
-        cb = self._callback
-        try:
-            cb(self)
-        except Exception:
-            print('Exception in callback %r for %r' % (cb, self))
 
+        # mark finished before running callback, the callback may
+        # resolve this future again (e.g. cancel it) re-entrantly
+        cb = self._callback
         self._status = self._FINISHED
         self._callback = None
+        if cb is None:
+            self._log_exc = self._exc_info is not None
+            return
+        if type(cb) is not list:
+            cb = (cb,)
+        for c in cb:
+            try:
+                c(self)
+            except Exception:
+                print('Exception in callback %r for %r' % (c, self))
 
 
-def _next(gen, future, value=None):
-    try:
-        if not value:
-            fut = gen.send(value)
-        else:
-            if value._exc_info:
-                fut = gen.throw(*value._exc_info)
-            else:
-                fut = gen.send(value._result)
-        fut.add_done_callback(lambda value: _next(gen, future, value))
-    except StopIteration as e:
-        future.set_result(e.value)
-    except Exception:
-        future.set_exc_info(sys.exc_info())
-        
+class Task(Future):
+    """future of a generator or an `async def` coroutine, which is stepped
+    each time the future it waits for is done. the bound `_step` is kept,
+    so a suspension allocates nothing. a future which is done already is
+    taken in place without a loop round trip, up to EAGER_MAX in a row"""
+
+    __slots__ = ["_gen", "_wakeup", "_priority"]
+
+    # steps taken on done futures in a row, before yielding to the loop.
+    # callbacks queued meanwhile run after them, so a task with buffered
+    # data is ahead of others for at most EAGER_MAX steps. see
+    # examples/test_await.py for the cost of a loop round trip per step
+    EAGER_MAX = 64
+
+    def __init__(self, gen):
+        super().__init__()
+        self._gen = gen
+        self._wakeup = self._step
+        self._priority = None   # priority class in IOLoop, IO if None
+        self._step()
+
+    def set_priority(self, priority: int):
+        """IOLoop.CONTROL, IO or BULK, class of loop callbacks resuming
+        this task after it yields to the loop"""
+        self._priority = priority
+
+    def _step(self, value=None):
+        gen = self._gen
+        eager = self.EAGER_MAX
+        while True:
+            try:
+                if value is None:
+                    fut = gen.send(None)
+                elif value._exc_info:
+                    fut = gen.throw(*value._exc_info)
+                else:
+                    fut = gen.send(value._result)
+                if not isinstance(fut, Future):
+                    fut = ensure_future(fut)
+            except StopIteration as e:
+                self._gen = self._wakeup = None
+                self.set_result(e.value)
+                return
+            except Exception:
+                self._gen = self._wakeup = None
+                self.set_exc_info(sys.exc_info())
+                return
+            if fut._status != Future._FINISHED:
+                fut.add_done_callback(self._wakeup)
+                return fut      # for micor.profiler, callers ignore it
+            fut._log_exc = False
+            eager -= 1
+            if not eager:
+                from .ioloop import IOLoop
+                loop = IOLoop.current()
+                if self._priority is None:
+                    loop.add_callsoon(self._wakeup, fut)
+                else:
+                    loop.add_callsoon_priority(self._priority, self._wakeup, fut)
+                return
+            value = fut
+
+
+def ensure_future(obj):
+    """wrap a generator or coroutine object into a Task, futures are
+    returned as they are"""
+    if isinstance(obj, Future):
+        return obj
+    if isinstance(obj, (GeneratorType, CoroutineType)):
+        return Task(obj)
+    raise TypeError("%r can't be waited for" % (obj,))
+
 
 def coroutine(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        future = Future()
         try:
             gen = func(*args, **kwargs)
         except Exception:
+            future = Future()
             future.set_exc_info(sys.exc_info())
             return future
-        else:
-            if isinstance(gen, GeneratorType):
-                _next(gen, future)
-                return future
+        if isinstance(gen, (GeneratorType, CoroutineType)):
+            return Task(gen)
+        future = Future()
         future.set_result(gen)
         return future
 
     return wrapper
 
+
+def gather(*futures):
+    """future resolved with a list of results of `futures`, in order. it
+    fails with the first error raised by any of them"""
+    futures = [ensure_future(f) for f in futures]
+    result = Future()
+    if not futures:
+        result.set_result([])
+        return result
+    pending = [len(futures)]
+
+    def on_done(fut):
+        if result.done():
+            return
+        if fut._exc_info:
+            result.set_exc_info(fut._exc_info)
+            return
+        pending[0] -= 1
+        if not pending[0]:
+            result.set_result([f._result for f in futures])
+
+    for f in futures:
+        f.add_done_callback(on_done)
+    return result
+
+
+def wait_any(*futures):
+    """future resolved with the first done one of `futures`, the others
+    keep running"""
+    futures = [ensure_future(f) for f in futures]
+    result = Future()
+
+    def on_done(fut):
+        if result.done():
+            return
+        for f in futures:
+            f.remove_done_callback(on_done)
+        result.set_result(fut)
+
+    for f in futures:
+        f.add_done_callback(on_done)
+        if result.done():
+            break
+    return result
+
+first_completed = wait_any
+
+
+def with_timeout(future, timeout: float, loop=None):
+    """cancel `future` with TimeoutError if it isn't done in `timeout`
+    seconds. `future` itself is returned"""
+    future = ensure_future(future)
+    if future.done():
+        return future
+    if loop is None:
+        from .ioloop import IOLoop
+        loop = IOLoop.current()
+    timer = loop.add_calllater(timeout,
+            lambda: future.cancel((errors.TimeoutError, None, None)))
+    future.add_done_callback(lambda f: loop.remove_timer(timer))
+    return future
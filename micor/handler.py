@@ -1,18 +1,22 @@
 ﻿import socket
+import os
 import errno
 import re
 import select
 import logging
 import time
 import struct
+import weakref
 from collections import deque
 from functools import partial
-from .gen import Future, coroutine
-from .utils import errno_from_exception, \
-    merge_prefix, tobytes
-from .ioloop import IOLoop, Timer
-from .import errors,utils
-from .resolvers.poll import resolver
+from itertools import islice
+from .gen import Future, coroutine, ensure_future, with_timeout
+from .utils import errno_from_exception, tobytes
+from .ioloop import IOLoop, Timer, sleep
+from .import errors,utils,process
+from .resolvers.poll import get_resolver
+
+_servers = weakref.WeakSet()    # listening servers, closed by `shutdown`
 
 
 class BaseHandler:
@@ -51,8 +55,9 @@ class BaseHandler:
                     type: int=0, 
                     proto: int=0, 
                     flags: int=0,
-                    timeout: int=0):
-        res = yield resolver.getaddrinfo(host, port, family, type, proto, flags, timeout)
+                    timeout: int=10):
+        res = yield get_resolver(self._loop).getaddrinfo(
+            host, port, family, type, proto, flags, timeout)
         return res
 
 
@@ -69,6 +74,12 @@ class _ServerHandler(BaseHandler):
         super().__init__(loop)
         self._addr = (ip, port)
         self.backlog = backlog
+        self.active = 0     # accepted connections still being handled
+        _servers.add(self)
+
+    def close(self):
+        if not self._sock._closed:
+            super().close()
         
     def create_sock(self, ip, port, socktype, proto, **sockopt):
         family = utils.ip_type(ip)
@@ -81,8 +92,14 @@ class _ServerHandler(BaseHandler):
         sock.setblocking(False)
         return sock
 
-    def set_socketopt(self, sock, **opt):
+    def set_socketopt(self, sock, reuse_port=None, **opt):
+        """`reuse_port` defaults to True in workers of `fork_processes`,
+        so that each worker binds its own listener"""
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port is None:
+            reuse_port = process.task_id() is not None
+        if reuse_port and utils.has_reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         return sock
 
 
@@ -123,7 +140,7 @@ class UDPServer(_ServerHandler):
             data, addr = self._sock.recvfrom(65535)
             logging.debug("UDP: accept %s:%d" % addr)
             h = self.conn_cls(sock, addr, data, self._loop)
-            future = self.handle_datagram(h, addr)
+            future = ensure_future(self.handle_datagram(h, addr))
 
             self._loop.add_future(future, lambda f: f.print_excinfo())
         except (OSError, IOError) as exc:
@@ -136,15 +153,67 @@ class UDPServer(_ServerHandler):
 
 class Connection(BaseHandler):
 
+    # keep the socket open when the peer sends FIN, so that data can still
+    # be written back to it. the owner must call `close` explicitly.
+    half_close = False
+
+    # bytes asked from kernel by each recv. it grows when a recv fills
+    # the request, and shrinks after continuous small recvs
+    RECV_MIN = 2048
+    RECV_INIT = 4096
+    RECV_MAX = 262144
+
+    # bytes read or written for one connection per loop pass. the rest is
+    # left to next pass, so that a busy connection can't starve others
+    IO_BUDGET = 1048576
+
+    # hard cap of bytes buffered by `read_until` and `read_until_regex`
+    READ_MAX = 104857600
+
+    # flow control of reads. while nobody waits for data, reading stops
+    # once READ_HIGH bytes are buffered, and resumes after the consumer
+    # takes the buffer down to READ_LOW
+    READ_HIGH = 4194304
+    READ_LOW = 1048576
+
+    # max chunks of write buffer passed to one sendmsg
+    IOV_MAX = 64
+
+    # flow control of writes. `write` completes at once while buffered
+    # bytes stay under WRITE_HIGH, otherwise it completes after the buffer
+    # drains to WRITE_LOW
+    WRITE_HIGH = 262144
+    WRITE_LOW = 65536
+
+    # coalesce writes, write buffer is flushed once per loop iteration
+    # instead of sending on each `write`
+    cork = False
+
+    # priority class of handler and deferred reads and writes in IOLoop,
+    # changed by `set_priority`
+    priority = IOLoop.IO
+
     def __init__(self, sock, addr, loop):
         super().__init__(loop)
         self._sock = sock
         self._addr = addr
         self._wbuf = deque()
         self._wbsize = 0
-        self._rbuf = deque()
+        self._wpos = 0              # bytes of _wbuf[0] already sent
+        self._flushing = False      # flush of corked writes is scheduled
+        self._wwaiters = deque()    # (future, nbytes) of writes above WRITE_HIGH
+        self._drainers = []         # futures of `drain`, resolved when _wbuf is empty
+        self._rbuf = bytearray()    # unread data is self._rbuf[_rpos: _rpos + _rbsize]
+        self._rpos = 0
         self._rbsize = 0
+        self._rlent = False         # a view of _rbuf was handed out by last read
+        self._rpaused = False       # reading stopped at READ_HIGH
+        self._rscan = 0             # unread bytes already searched by read_until
+        self._rsize = self.RECV_INIT
+        self._rsmall = 0
         self._closed = False
+        self._eof = False
+        self._rdhup = False         # FIN was received, though maybe not read yet
         if self._sock:
             self.register(self.events)
 
@@ -153,155 +222,470 @@ class Connection(BaseHandler):
             return
         super().close()
         self._closed = True
-        self._wbuf, self._rbuf = deque(), deque()
-        self._wbsize, self._rbsize = 0, 0
+        self._wbuf, self._rbuf = deque(), bytearray()
+        self._wbsize, self._rbsize, self._rpos, self._wpos = 0, 0, 0, 0
+        self._rscan = 0
+        # wake up coroutines still waiting on this connection
+        rfut, wfut = self._rfut, self._wfut
+        self._rfut, self._wfut = None, None
+        exc = errors.ConnectionClosed(self._addr)
+        for fut in (rfut, wfut):
+            if fut and not fut.done():
+                fut.cancel((errors.ConnectionClosed, exc, None))
+        self._cancel_writers((errors.ConnectionClosed, exc, None))
+
+    def register(self, events=None, cb=None):
+        if not self._eof and not self._rpaused:
+            super().register(events, cb)
+        elif not self._sock._closed:
+            # read side is finished or paused, only watch for writable and error
+            events = (events or 0) | self._loop.ERROR
+            self._loop.register(self._sock, events, cb or self.handle)
+        if self.priority != IOLoop.IO:
+            self._loop.set_priority(self._sock, self.priority)
+
+    def set_priority(self, priority: int):
+        """IOLoop.CONTROL, IO or BULK. bulk transfers let handshakes,
+        timers and other flows go first"""
+        self.priority = priority
+        if self._sock and not self._closed:
+            self._loop.set_priority(self._sock, priority)
+
+    def shutdown_write(self):
+        """send FIN to the other side, reading is still available.
+        pending data in write buffer will be discarded, so wait for the
+        future returned by `drain` first"""
+        if self._closed:
+            return
+        try:
+            self._sock.shutdown(socket.SHUT_WR)
+        except (OSError, IOError) as exc:
+            logging.debug("TCP: shutdown %s:%d failed: %s" % (self._addr[:2] + (exc,)))
 
     @property
     def events(self):
-        e = self._loop.READ
+        e = 0 if self._eof or self._rpaused else self._loop.READ
+        if utils.has_ET:
+            # edge-triggered writable is only reported when the send buffer
+            # drains, so keep it registered instead of toggling it
+            if e:
+                e |= select.EPOLLRDHUP
+            return e | self._loop.WRITE | select.EPOLLET
         if self._wbsize:
             e |= self._loop.WRITE
-        if utils.has_ET:
-            e |= select.EPOLLET
         return e
 
+    def _reserve_rbuf(self, size):
+        """make sure there is at least `size` bytes free space at the tail
+        of read buffer. bytes under a view handed out by last read are
+        never overwritten, a new buffer is used instead"""
+        end = self._rpos + self._rbsize
+        if len(self._rbuf) - end >= size:
+            return
+        if not self._rlent and len(self._rbuf) - self._rbsize >= size:
+            # move unread data to the head, no allocation
+            self._rbuf[:self._rbsize] = self._rbuf[self._rpos:end]
+        else:
+            cap = len(self._rbuf)
+            if self._rbsize + size > cap:
+                cap = max(self._rbsize + size, cap << 1)
+            buf = bytearray(cap)
+            buf[:self._rbsize] = memoryview(self._rbuf)[self._rpos:end]
+            self._rbuf = buf
+            self._rlent = False
+        self._rpos = 0
+
+    def _adapt_recv_size(self, n):
+        if n >= self._rsize:
+            self._rsize = min(self._rsize << 1, self.RECV_MAX)
+            self._rsmall = 0
+        elif n < (self._rsize >> 1):
+            self._rsmall += 1
+            if self._rsmall >= 2:
+                self._rsize = max(self._rsize >> 1, self.RECV_MIN)
+                self._rsmall = 0
+        else:
+            self._rsmall = 0
+
     def on_read(self):
-        data = b''
-        try:
-            data = self._sock.recv(65535)
-        except (OSError, IOError) as exc:
-            if errno_from_exception(exc) in (
-                errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+        # recv until EAGAIN or a short read, otherwise data left in kernel
+        # buffer won't be notified again in edge-triggered mode. a FIN behind
+        # the data is told by RDHUP, read until EOF then
+        if self._rpaused:
+            return
+        n = 0
+        while True:
+            size = self._rsize
+            self._reserve_rbuf(size)
+            try:
+                end = self._rpos + self._rbsize
+                with memoryview(self._rbuf) as view:
+                    nread = self._sock.recv_into(view[end: end + size], size)
+            except (OSError, IOError) as exc:
+                if errno_from_exception(exc) in (
+                    errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self._fail(exc)     # e.g. ECONNRESET, it's not an EOF
                 return
+            self._adapt_recv_size(nread)
+            self._rbsize += nread
+            n += nread
+            if not nread:
+                self._eof = True
+                break
+            if self._rbsize >= self.READ_HIGH and not self._rfut:
+                self._rpaused = True    # resumed by `_pop_from_rbuf`
+                break
+            if nread < size and not self._rdhup:
+                break
+            if n >= self.IO_BUDGET:
+                self._loop.add_callsoon_priority(self.priority, self._read_more)
+                break
+        if not n and not self._eof:
+            return
         if self._rfut:
             fut = self._rfut
             self._rfut = None
-            fut.set_result(data)
-        else:
-            if not data:
-                self.close()
-            else:
-                self._rbuf.append(data)
-                self._rbsize += len(data)
+            fut.set_result(n)
+        elif self._eof and not self._rbsize and not self.half_close:
+            self.close()
+
+    def _read_more(self):
+        """continue a read stopped by IO_BUDGET"""
+        if not self._closed and not self._eof:
+            self.on_read()
+
+    def _resume_reading(self):
+        """undo READ_HIGH pause. data left in kernel buffer won't raise
+        another edge, so read it instead of waiting for the loop"""
+        self._rpaused = False
+        if self._closed:
+            return
+        self.register(self.events)
+        self._loop.add_callsoon_priority(self.priority, self._read_more)
+
+    def _send(self):
+        """send head of write buffer, several chunks are sent by one
+        syscall if sendmsg is available. return bytes sent"""
+        wbuf = self._wbuf
+        first = wbuf[0]
+        if self._wpos:
+            first = memoryview(first)[self._wpos:]
+        if len(wbuf) == 1 or not utils.has_sendmsg:
+            return self._sock.send(first)
+        iov = [first]
+        iov.extend(islice(wbuf, 1, self.IOV_MAX))
+        return self._sock.sendmsg(iov)
+
+    def _consume_wbuf(self, num):
+        """drop `num` sent bytes from write buffer, a partly sent chunk
+        stays in place and `_wpos` records the sent part of it"""
+        self._wbsize -= num
+        wbuf = self._wbuf
+        num += self._wpos
+        while num and num >= len(wbuf[0]):
+            num -= len(wbuf.popleft())
+        self._wpos = num
 
     def on_write(self):
         bytes_num = 0
-        merge_prefix(self._wbuf, 65535)
         while self._wbsize:
             try:
-                num = self._sock.send(self._wbuf[0])
-                if num:
-                    merge_prefix(self._wbuf, num)
-                    self._wbuf.popleft()
-                    bytes_num += num
-                    self._wbsize -= num
-                else:
+                num = self._send()
+                if not num:
+                    break
+                self._consume_wbuf(num)
+                bytes_num += num
+                if self._wpos:
+                    break       # a chunk is half sent, send buffer is full
+                if bytes_num >= self.IO_BUDGET and self._wbsize:
+                    if not self._flushing:
+                        self._flushing = True
+                        self._loop.add_callsoon_priority(self.priority, self.flush)
                     break
             except (socket.error, IOError, OSError) as exc:
                 eno = errno_from_exception(exc)
                 if eno in (errno.EAGAIN, errno.EINPROGRESS, errno.EWOULDBLOCK):     # 缓冲区满
                     break
                 else:
-                    self.close()
                     logging.warn("TCP: Write error on %d: %s" % (self._sock.fileno(), exc))
+                    self.close()
                     break
+        if self._wwaiters and self._wbsize <= self.WRITE_LOW:
+            self._wake_writers()
+        if self._drainers and not self._wbsize:
+            drainers, self._drainers = self._drainers, []
+            for fut in drainers:
+                fut.set_result(bytes_num)
         if self._wfut and not self._wbsize:
             fut = self._wfut
             self._wfut = None
             fut.set_result(bytes_num)
 
+    def _wake_writers(self):
+        waiters, self._wwaiters = self._wwaiters, deque()
+        for fut, n in waiters:
+            fut.set_result(n)
+
+    def _cancel_writers(self, excinfo):
+        waiters, self._wwaiters = self._wwaiters, deque()
+        for fut, _ in waiters:
+            fut.cancel(excinfo)
+        drainers, self._drainers = self._drainers, []
+        for fut in drainers:
+            fut.cancel(excinfo)
+
+    def flush(self):
+        """send corked writes, or writes stopped by IO_BUDGET now"""
+        self._flushing = False
+        if self._closed:
+            return
+        if self._wbsize:
+            self.on_write()
+        if not self._closed:
+            self.register(self.events)
+
+    def _fail(self, exc):
+        """raise socket error `exc` to pending reads and writes, and close"""
+        logging.debug("TCP: socket %s:%d error: %s" % (self._addr[:2] + (exc,)))
+        excinfo = (type(exc), exc, None)
+        rfut, wfut = self._rfut, self._wfut
+        self._rfut, self._wfut = None, None
+        for fut in (rfut, wfut):
+            if fut and not fut.done():
+                fut.cancel(excinfo)
+        self._cancel_writers(excinfo)
+        self.close()
+
     def on_error(self):
         logging.warn("TCP: socket %s:%d error" % self._addr)
         if self._wfut:
             self._wfut.cancel((socket.error, None, None))
         if self._rfut:
             self._rfut.cancel((socket.error, None, None))
+        self._cancel_writers((socket.error, None, None))
         self.close()
 
     def handle(self, sock, fd, events):
-        if events & self._loop.ERROR:
+        if utils.has_ET and events & select.EPOLLRDHUP:
+            self._rdhup = True
+        if events & self._loop.READ:
+            self.on_read()      # peer may hang up with data still pending
+        elif events & self._loop.ERROR:
             self.on_error()
             return
-        if events & self._loop.READ:
-            self.on_read()
-        if events & self._loop.WRITE:
+        if events & self._loop.WRITE and not self._closed:
             self.on_write()
         if not self._closed:
             self.register(self.events)
 
-    def _pop_from_rbuf(self, size):
-        merge_prefix(self._rbuf, size)
-        res = self._rbuf.popleft()
-        self._rbsize -= len(res)
+    def _pop_from_rbuf(self, size, copy=True):
+        """pop `size` bytes from read buffer. a memoryview of the buffer
+        is returned if `copy` is False"""
+        size = max(size, 0)
+        start = self._rpos
+        self._rscan = 0
+        self._rpos += size
+        self._rbsize -= size
+        res = memoryview(self._rbuf)[start: self._rpos]
+        if copy:
+            res = bytes(res)
+        else:
+            self._rlent = True
+        if not self._rbsize and not self._rlent:
+            self._rpos = 0
+            if len(self._rbuf) > (self._rsize << 2):
+                self._rbuf = bytearray()     # give back memory of a huge read
+        if self._rpaused and self._rbsize < self.READ_LOW:
+            self._resume_reading()
         return res
 
     @coroutine
-    def read_forever(self, timeout: int=0):
+    def read_forever(self, timeout: int=0, copy: bool=True):
+        """read whatever available. if `copy` is False, a memoryview of
+        the read buffer is returned, it keeps valid until next read"""
+        self._rlent = False
         if self._rbsize > 0:
-            chunk = yield self.read_from_buf(self._rbsize)
+            chunk = yield self.read_from_buf(self._rbsize, copy)
             return chunk
+        if self._eof:
+            if not self.half_close:
+                self.close()
+            raise errors.ConnectionClosed(self._addr)
         future = self.read_from_fd()
-        timer = None
         if timeout:
-            timer = self._loop.add_calllater(timeout,
-                    lambda: future.cancel((errors.TimeoutError, None, None))
-                )
-        chunk = yield future
-        if timer:
-            self._loop.remove_timer(timer)
-        if not chunk:
-            self.close()
+            with_timeout(future, timeout, self._loop)
+        yield future
+        if not self._rbsize:
+            if not self.half_close:
+                self.close()
             raise errors.ConnectionClosed(self._addr)
-        return chunk
+        return self._pop_from_rbuf(self._rbsize, copy)
 
     def read_from_fd(self):
+        """future resolved with number of bytes appended to read buffer"""
         future = Future()
         self._rfut = future
+        if self._rpaused:
+            self._resume_reading()      # someone needs more than READ_HIGH
+        return future
+
+    def _read_before(self, deadline):
+        """`read_from_fd` which fails with TimeoutError at `deadline`, on
+        clock of IOLoop.time(). the connection is closed then, as the
+        rest of a message would be read by nobody"""
+        future = self.read_from_fd()
+        if deadline is not None:
+            with_timeout(future, max(deadline - self._loop.time(), 0), self._loop)
+            future.add_done_callback(self._close_on_timeout)
         return future
 
-    def read_from_buf(self, n):
+    def _close_on_timeout(self, future):
+        if future._exc_info and future._exc_info[0] is errors.TimeoutError:
+            self.close()
+
+    def read_from_buf(self, n, copy=True):
         assert self._rbsize >= n
         future = Future()
-        res = self._pop_from_rbuf(n)
-        self._loop.add_callsoon(lambda v: v.set_result(res), future)
+        future.set_result(self._pop_from_rbuf(n, copy))
         return future
     
     @coroutine
-    def read_nbytes(self, n:int, timeout: int=0) -> bytes:
+    def read_nbytes(self, n:int, timeout: int=0, copy: bool=True) -> bytes:
+        """read exactly `n` bytes. if `copy` is False, a memoryview of
+        the read buffer is returned, it keeps valid until next read"""
+        self._rlent = False
         if n <= self._rbsize:
-            res = yield self.read_from_buf(n)
+            res = yield self.read_from_buf(n, copy)
             return res
+        if self._eof:
+            if not self.half_close:
+                self.close()
+            raise errors.ConnectionClosed(self._addr)
 
-        def on_timeout():
-            self.close()
-            self._rfut.cancel((errors.TimeoutError, None, None))
+        deadline = self._loop.time() + timeout if timeout else None
+        while True:
+            yield self._read_before(deadline)
+            if self._rbsize >= n:
+                return self._pop_from_rbuf(n, copy)
+            if self._eof:
+                if not self.half_close:
+                    self.close()
+                raise errors.ConnectionClosed(self._addr)
+            
 
-        timer = None
-        if timeout:
-            timer = self._loop.add_calllater(timeout, on_timeout)
+    def _find_delimiter(self, delimiter):
+        """search `delimiter` in unread data, from where the last search
+        stopped. return bytes up to the end of delimiter, or -1"""
+        rpos = self._rpos
+        start = rpos + max(self._rscan - len(delimiter) + 1, 0)
+        pos = self._rbuf.find(delimiter, start, rpos + self._rbsize)
+        if pos < 0:
+            self._rscan = self._rbsize
+            return -1
+        return pos - rpos + len(delimiter)
+
+    def _find_regex(self, regex):
+        """search `regex` in unread data. return bytes up to the end of
+        match, or -1"""
+        m = regex.search(self._rbuf, self._rpos, self._rpos + self._rbsize)
+        return m.end() - self._rpos if m else -1
+
+    def read_until(self, delimiter: bytes, max_bytes: int=0,
+            timeout: int=0, copy: bool=True):
+        """read until `delimiter`, delimiter is included in the result.
+        only new data is searched after each recv. UnsatisfiableReadError
+        is raised and connection is closed if delimiter is not found within
+        `max_bytes` (READ_MAX if 0) bytes"""
+        return self._read_until(
+            partial(self._find_delimiter, delimiter), max_bytes, timeout, copy)
+
+    def read_until_regex(self, regex, max_bytes: int=0,
+            timeout: int=0, copy: bool=True):
+        """read until a match of `regex`, match is included in the result.
+        unlike `read_until`, the whole unread data is searched after each
+        recv, as a match may start anywhere. `max_bytes` bounds the cost"""
+        if isinstance(regex, (str, bytes)):
+            regex = re.compile(tobytes(regex))
+        return self._read_until(
+            partial(self._find_regex, regex), max_bytes, timeout, copy)
 
+    @coroutine
+    def _read_until(self, find, max_bytes, timeout, copy):
+        self._rlent = False
+        max_bytes = min(max_bytes or self.READ_MAX, self.READ_MAX)
+        n = find()
+        if 0 <= n <= max_bytes:
+            res = yield self.read_from_buf(n, copy)
+            return res
+
+        deadline = self._loop.time() + timeout if timeout else None
         while True:
-            chunk = yield self.read_from_fd()
-            if chunk:
-                self._rbuf.append(chunk)
-                self._rbsize += len(chunk)
-                if self._rbsize >= n:
-                    if timer:
-                        self._loop.remove_timer(timer)
-                    return self._pop_from_rbuf(n)
-            else:
+            if n > max_bytes or (n < 0 and self._rbsize >= max_bytes):
                 self.close()
-                if timer:
-                    self._loop.remove_timer(timer)
-                raise errors.ConnectionClosed(self._addr)
-            
+                exc = errors.UnsatisfiableReadError(
+                    "delimiter not found in %d bytes from %s" % (max_bytes, self._addr))
+                break
+            if n >= 0:
+                exc = None
+                break
+            if self._eof:
+                if not self.half_close:
+                    self.close()
+                exc = errors.ConnectionClosed(self._addr)
+                break
+            yield self._read_before(deadline)
+            n = find()
+
+        if exc:
+            raise exc
+        return self._pop_from_rbuf(n, copy)
 
     def write(self, data):
-        self._wbuf.append(data)
-        self._wbsize += len(data)
-        self.register(self.events)
+        if self._closed:
+            raise errors.ConnectionClosed(self._addr)
+        wbuf, n = self._wbuf, len(data)
+        wbuf.append(data)
+        self._wbsize += n
+        if self.cork:
+            if not self._flushing:
+                self._flushing = True
+                self._loop.add_callsoon_priority(self.priority, self.flush)
+        elif self._wbsize == n:
+            self.on_write()     # nothing queued before, send it right now
+
+        f = Future()
+        if self._closed:
+            f.cancel((errors.ConnectionClosed, errors.ConnectionClosed(self._addr), None))
+            return f
+        if isinstance(data, memoryview) and wbuf and wbuf[-1] is data:
+            # the view may be lent from a read buffer, which is reused
+            # by the next read. keep a copy of the unsent part
+            if len(wbuf) == 1:
+                data, self._wpos = data[self._wpos:], 0
+            wbuf[-1] = bytes(data)
+        if self._wbsize <= self.WRITE_HIGH:
+            f.set_result(n)
+        else:
+            self._wwaiters.append((f, n))
+        if not self.cork:
+            self.register(self.events)
+        return f
+
+    def drain(self, timeout: int=0):
+        """future resolved when the write buffer is empty, i.e. all data
+        written so far is handed to kernel. wait for it before
+        `shutdown_write` or `close`, which discard unsent data"""
         f = Future()
-        self._wfut = f
+        if self._closed:
+            f.cancel((errors.ConnectionClosed, errors.ConnectionClosed(self._addr), None))
+            return f
+        if not self._wbsize:
+            f.set_result(0)
+            return f
+        self._drainers.append(f)
+        if timeout:
+            with_timeout(f, timeout, self._loop)
         return f
 
 
@@ -309,7 +693,10 @@ class TCPServer(_ServerHandler):
 
     def __init__(self, ip, port, 
             backlog=128, loop=None, 
-            conn_cls=Connection, **sockopt):
+            conn_cls=Connection, worker_loops=None, **sockopt):
+        """if `worker_loops` is given, e.g. by `start_loop_threads`, this
+        loop only accepts, and accepted sockets are served by worker loops
+        in turn"""
         super().__init__(ip, port, backlog, loop, **sockopt)
         self._sock = self.create_sock(
             ip, port, socket.SOCK_STREAM, socket.SOL_TCP, **sockopt
@@ -317,6 +704,8 @@ class TCPServer(_ServerHandler):
         self._sock.listen(self.backlog)
         self.register()
         self.conn_class = conn_cls
+        self.worker_loops = worker_loops
+        self._next_worker = 0
 
     def handle(self, sock, fd, events):
         if events & self._loop.ERROR:
@@ -324,13 +713,28 @@ class TCPServer(_ServerHandler):
             raise Exception('server_socket error')
         try:
             conn, addr = self._sock.accept()
+            conn.setblocking(False)
             logging.debug("TCP: accept %s:%d" % addr)
-            h = self.conn_class(conn, addr, loop = self._loop)
-            future = self.handle_conn(h, addr)
-            self._loop.add_future(future, lambda f: f.print_excinfo())
-
         except (OSError, IOError) as exc:
             logging.warn("TCP: accept error: %s" % exc)
+            return
+        if self.worker_loops:
+            loop = self.worker_loops[self._next_worker]
+            self._next_worker = (self._next_worker + 1) % len(self.worker_loops)
+            loop.add_callsoon_threadsafe(self.serve, conn, addr, loop)
+        else:
+            self.serve(conn, addr, self._loop)
+
+    def serve(self, conn, addr, loop):
+        """serve accepted socket `conn` in `loop`"""
+        h = self.conn_class(conn, addr, loop=loop)
+        self.active += 1
+        future = ensure_future(self.handle_conn(h, addr))
+        loop.add_future(future, self._on_served)
+
+    def _on_served(self, future):
+        self.active -= 1
+        future.print_excinfo()
 
     @coroutine
     def handle_conn(self, conn, addr):
@@ -339,26 +743,23 @@ class TCPServer(_ServerHandler):
 
 class TCPClient(Connection):
 
-    def __init__(self, **sockopt):
-        loop = IOLoop.current()
+    def __init__(self, loop: IOLoop=None, **sockopt):
+        loop = loop or IOLoop.current()
         self._connected = False
         super().__init__(None, None, loop)
-        self._connect_timer = None
 
     def on_connected(self):
         self._connected = True
-        self._wfut.set_result(None)
+        fut, self._wfut = self._wfut, None
+        if fut:
+            fut.set_result(None)
     
     def _inline_connect(self, family, type, proto, addr, timeout):
         self._sock = socket.socket(family, type, proto)
         self._sock.setblocking(False)
         self._addr = addr
         future = Future()
-
-        self._connect_timer = self._loop.add_calllater(timeout, lambda: future.cancel(
-            (errors.TimeoutError, None, None)
-        ))
-
+        with_timeout(future, timeout, self._loop)
         self._wfut = future
         self.register(self._loop.WRITE)
         try:
@@ -381,22 +782,22 @@ class TCPClient(Connection):
                 break
             except errors.TimeoutError:
                 timeout -= (time.time() - now)
-        if self._connect_timer:
-            self._connect_timer.cancel()
-        self._connect_timer = None
 
-    def handle_events(self, sock, fd, events):
-        if events & self._loop.ERROR:
-            self.on_error()
-            return
-        if events & self._loop.WRITE:
-            if not self._connected:
-                self.on_connected()
-            else:
-                self.on_write()
-        if events & self._loop.READ:
-            self.on_read()
-        self.register(self.events)
+    def handle(self, sock, fd, events):
+        if not self._connected:
+            # outcome of the non-blocking connect goes before any read,
+            # a refused connect is reported as readable too
+            err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err or events & self._loop.ERROR:
+                err = err or errno.ECONNRESET
+                self._fail(OSError(err, os.strerror(err)))
+                return
+            if not events & self._loop.WRITE:
+                return
+            self.on_connected()
+            if self._closed:
+                return
+        super().handle(sock, fd, events)
 
 
 class UDPClient(BaseHandler):
@@ -417,11 +818,14 @@ class UDPClient(BaseHandler):
         if events & self._loop.ERROR:
             self.close()
             logging.warn("UDP: socket %s:%d error" % self._addr)
-            self._rfut.cancel((socket.error, None, None))
+            fut, self._rfut = self._rfut, None
+            if fut:
+                fut.cancel((socket.error, None, None))
 
     def on_read(self, data, svr):
-        if self._rfut:
-            self._rfut.set_result((data, svr))
+        if self._rfut and not self._rfut.done():
+            fut, self._rfut = self._rfut, None
+            fut.set_result((data, svr))
         else:
             self._rbuf.append((data, svr))
 
@@ -431,22 +835,32 @@ class UDPClient(BaseHandler):
     @coroutine
     def read(self, timeout=0):
         if self._rbuf:
-            future = Future()
-            res = self._rbuf.pop(0)
-            self._loop.add_callsoon(lambda: future.set_result(res))
-            yield future
-            return res
-        timer = None
-        def on_timeout():
-            self.close()
-            self._rfut.cancel((errors.TimeoutError, None, None))
+            return self._rbuf.pop(0)
+        future = self._read()
         if timeout:
-            timer = self._loop.add_calllater(timeout, on_timeout)
-        res = yield self._read()
-        if timer:
-            self._loop.remove_timer(timer)
+            with_timeout(future, timeout, self._loop)
+        try:
+            res = yield future
+        except errors.TimeoutError:
+            self.close()
+            raise
         return res
 
     def _read(self):
         self._rfut = Future()
-        return self._rfut
\ No newline at end of file
+        return self._rfut
+
+
+@coroutine
+def shutdown(grace: float=30, loop: IOLoop=None):
+    """graceful stop of `loop`. its servers stop accepting, connections
+    they accepted are given `grace` seconds to be handled, then the loop
+    is stopped"""
+    loop = loop or IOLoop.current()
+    servers = [server for server in _servers if server._loop is loop]
+    for server in servers:
+        server.close()
+    deadline = loop.time() + grace
+    while loop.time() < deadline and any(server.active for server in servers):
+        yield sleep(0.1, loop)
+    loop.stop()
@@ -1,6 +1,9 @@
-﻿import select
+﻿import os
+import select
 import heapq
+import math
 import time
+import threading
 from functools import partial
 from collections import defaultdict, deque
 from .gen import Future
@@ -50,6 +53,213 @@ except:
     PollImpl = SelectImpl
 
 
+class Waker:
+    """fd which wakes the loop up from poll. an eventfd if available,
+    otherwise a pipe"""
+
+    def __init__(self):
+        if hasattr(os, "eventfd"):
+            self._rfd = self._wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._rfd, self._wfd = os.pipe()
+            os.set_blocking(self._rfd, False)
+            os.set_blocking(self._wfd, False)
+        self._closed = False
+
+    def fileno(self):
+        return self._rfd
+
+    def wake(self):
+        if self._closed:
+            return
+        try:
+            os.write(self._wfd, b"\x01\x00\x00\x00\x00\x00\x00\x00")
+        except (BlockingIOError, OSError):
+            pass    # already readable, or closed
+
+    def consume(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        os.close(self._rfd)
+        if self._wfd != self._rfd:
+            os.close(self._wfd)
+
+
+class TimerHeap:
+    """timers kept in a binary heap. a cancelled timer stays in the heap
+    until it's popped, or the heap is compacted"""
+
+    def __init__(self, now: float):
+        self._timers = list()
+        self._cancels = 0
+
+    def __len__(self):
+        return len(self._timers) - self._cancels
+
+    @property
+    def cancelled(self) -> int:
+        """cancelled timers still kept in the heap"""
+        return self._cancels
+
+    def add(self, timer):
+        heapq.heappush(self._timers, timer)
+
+    def remove(self, timer):
+        if timer.callback is not None:      # neither fired nor cancelled
+            timer.callback = None
+            self._cancels += 1
+
+    def next_due(self):
+        """due time of the earliest timer, None if there is no timer"""
+        return self._timers[0].due if self._timers else None
+
+    def pop_due(self, now: float, ready):
+        """append callbacks of timers expired at `now` to `ready`"""
+        timers = self._timers
+        while timers:
+            if timers[0].callback is None:
+                heapq.heappop(timers)
+                self._cancels -= 1
+            elif timers[0].due <= now:
+                timer = heapq.heappop(timers)
+                ready.append(timer.callback)
+                timer.callback = None
+            else:
+                break
+
+        if self._cancels > 512 and self._cancels > (len(timers) >> 1):
+            self._cancels = 0
+            self._timers = [t for t in timers if t.callback is not None]
+            heapq.heapify(self._timers)
+
+
+class TimingWheel:
+    """hashed hierarchical timing wheel. adding and cancelling a timer
+    are O(1), expiration is rounded up to TICK, so timers due within the
+    same tick fire together. level 0 has one slot per tick, a slot of
+    level n covers a whole turn of level n-1, whose timers are cascaded
+    down when level n-1 wraps around. timers due beyond a turn of the
+    top level wait in an overflow set, which is placed again each time
+    the top level wraps around"""
+
+    TICK = 0.01
+    SLOTS = (256, 64, 64, 64)
+
+    def __init__(self, now: float, tick: float=0):
+        self._tick = tick or self.TICK
+        self._wheels = [[set() for _ in range(n)] for n in self.SLOTS]
+        self._shifts = []       # ticks covered by one slot, as bit shift
+        shift = 0
+        for n in self.SLOTS:
+            self._shifts.append(shift)
+            shift += n.bit_length() - 1
+        self._span = 1 << shift     # ticks covered by all levels
+        self._limits = [1 << n for n in self._shifts[1:]]
+        self._masks = [n - 1 for n in self.SLOTS]
+        self._overflow = set()  # timers due a whole span or more later
+        self._current = int(now / self._tick)   # next tick to expire
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    cancelled = 0       # cancelled timers are dropped at once
+
+    def _place(self, timer):
+        expire = math.ceil(timer.due / self._tick)
+        delta = expire - self._current
+        if delta < self.SLOTS[0]:
+            if delta < 0:
+                expire = self._current
+            bucket = self._wheels[0][expire & self._masks[0]]
+        elif delta >= self._span:
+            bucket = self._overflow
+        else:
+            level = 1
+            for limit in self._limits[1:]:
+                if delta < limit:
+                    break
+                level += 1
+            bucket = self._wheels[level][
+                (expire >> self._shifts[level]) & self._masks[level]]
+        bucket.add(timer)
+        timer._bucket = bucket
+
+    def add(self, timer):
+        self._place(timer)
+        self._count += 1
+
+    def remove(self, timer):
+        bucket = timer._bucket
+        if bucket is not None:
+            bucket.discard(timer)
+            timer._bucket = None
+            self._count -= 1
+
+    def next_due(self):
+        """time of the next tick holding a timer, or of the next cascade.
+        None if there is no timer"""
+        if not self._count:
+            return None
+        wheel, mask = self._wheels[0], self.SLOTS[0] - 1
+        tick = self._current
+        if not tick & mask:
+            return tick * self._tick    # cascade is pending
+        while True:
+            if wheel[tick & mask]:
+                break
+            tick += 1
+            if not tick & mask:
+                break       # timers of upper levels are cascaded here
+        return tick * self._tick
+
+    def _cascade(self):
+        for level in range(1, len(self.SLOTS)):
+            idx = (self._current >> self._shifts[level]) & (self.SLOTS[level] - 1)
+            bucket = self._wheels[level][idx]
+            self._wheels[level][idx] = set()
+            for timer in bucket:
+                self._place(timer)
+            if idx:
+                return
+        # the top level wrapped around, overflow timers due within its
+        # next turn go to their slots, the others wait for another turn
+        overflow, self._overflow = self._overflow, set()
+        for timer in overflow:
+            self._place(timer)
+
+    def pop_due(self, now: float, ready):
+        """append callbacks of timers expired at `now` to `ready`"""
+        last = int(now / self._tick)
+        if last < self._current:
+            return      # within the tick expired last time
+        if not self._count:
+            self._current = last + 1
+            return
+        wheel, mask = self._wheels[0], self.SLOTS[0] - 1
+        while self._current <= last and self._count:
+            idx = self._current & mask
+            if not idx:
+                self._cascade()
+            bucket = wheel[idx]
+            if bucket:
+                wheel[idx] = set()
+                self._count -= len(bucket)
+                for timer in sorted(bucket):
+                    timer._bucket = None
+                    ready.append(timer.callback)
+            self._current += 1
+        self._current = max(self._current, last + 1)
+
+
 class IOLoop:
 
     READ = _EPOLLIN = 0x001
@@ -58,39 +268,132 @@ class IOLoop:
 
     TIMEOUT = 10
 
-    DEFAULT_HANDLER = (None, 0, None)
+    # priority classes of callbacks and fd handlers. each iteration runs
+    # ready callbacks of CONTROL, then IO, then BULK; fd handlers tagged
+    # BULK are called after other handlers of the same poll
+    CONTROL = 0
+    IO = 1
+    BULK = 2
+
+    # seconds of IO and BULK callbacks run per iteration, the rest is left
+    # to next iteration after a poll, so that a burst of callbacks can't
+    # delay timers and new events. CONTROL callbacks aren't limited, and
+    # at least one callback of each class runs. 0 for no limit
+    READY_BUDGET = 0.002
+
+    # TimerHeap or TimingWheel. the latter drops a cancelled timer at once
+    # instead of keeping it until compaction, and is faster with many
+    # timers, see examples/test_timers.py. but it rounds dues up to TICK,
+    # the heap stays default for exact dues
+    TIMER_IMPL = TimerHeap
 
-    _instance = None
+    _local = threading.local()     # current loop of each thread
+
+    # a micor.metrics.LoopMetrics to instrument the loop, see `enable_metrics`
+    metrics = None
+
+    # a micor.watchdog.Watchdog reporting blocked iterations, see `enable_watchdog`
+    watchdog = None
 
     @classmethod
     def current(cls):
-        if not cls._instance:
-            cls._instance = cls()
-        return cls._instance
+        loop = getattr(cls._local, "instance", None)
+        if loop is None:
+            loop = cls._local.instance = cls()
+        return loop
+
+    def make_current(self):
+        """make this loop current of the calling thread"""
+        IOLoop._local.instance = self
+
+    @classmethod
+    def clear_current(cls):
+        """drop the current loop, `current` creates a new one next time.
+        called in a forked child, as epoll is shared with parent"""
+        loop = getattr(cls._local, "instance", None)
+        if loop is not None:
+            loop._impl.close()
+            loop._waker.close()
+            cls._local.instance = None
 
     def __init__(self):
         self._stop = False
-        self._ready = deque()
-        self._timers = list()
-        self._timer_cancels = 0
-        self._fds = dict()
+        self._ready = deque()   # IO callbacks
+        self._control = deque()
+        self._bulk = deque()
+        self._queues = (self._control, self._ready, self._bulk)     # by priority
+        self._now = time.monotonic()
+        self._timers = self.TIMER_IMPL(self._now)
+        self._fds = list()      # [sock, mode, handler, priority] indexed by fd, None if unused
         self._impl = PollImpl()
+        self._executor = None
+        self._waking = False    # waker is written, but not consumed yet
+        self._beat = 0          # bumped around poll, odd while running handlers
+        self._thread_id = None  # thread running this loop
+        self._waker = Waker()
+        self.register(self._waker, self.READ, self._on_wake)
+
+    def time(self) -> float:
+        """monotonic clock of the loop, it's cached and updated once per
+        iteration. dues of timers are based on it"""
+        return self._now
+
+    def update_time(self):
+        self._now = time.monotonic()
 
     def add_callsoon(self, callback, *args, **kwargs):
         fn = partial(callback, *args, **kwargs)
         self._ready.append(fn)
 
+    def add_callsoon_priority(self, priority: int, callback, *args, **kwargs):
+        """`add_callsoon` with priority class CONTROL, IO or BULK"""
+        self._queues[priority].append(partial(callback, *args, **kwargs))
+
+    def add_callsoon_threadsafe(self, callback, *args, **kwargs):
+        """`add_callsoon` for other threads, loop is waked up if it's
+        blocked in poll"""
+        self._ready.append(partial(callback, *args, **kwargs))
+        if not self._waking:
+            self._waking = True
+            self._waker.wake()
+
+    def _on_wake(self, sock, fd, events):
+        # consume first, a wake written after it is seen by next poll
+        self._waker.consume()
+        self._waking = False
+
+    def run_in_executor(self, executor, fn, *args):
+        """run `fn(*args)` in `executor`, a concurrent.futures executor, or
+        a thread pool owned by the loop if None. return a Future resolved
+        in loop thread"""
+        if executor is None:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor()
+            executor = self._executor
+        future = Future()
+
+        def copy_result(cfut):
+            exc = cfut.exception()
+            if exc is not None:
+                future.set_exc_info((type(exc), exc, exc.__traceback__))
+            else:
+                future.set_result(cfut.result())
+
+        executor.submit(fn, *args).add_done_callback(
+            lambda cfut: self.add_callsoon_threadsafe(copy_result, cfut))
+        return future
+
     def add_calllater(self, delay: int, cb):
-        timer = Timer(time.time() + delay, cb)
-        heapq.heappush(self._timers, timer)
+        timer = Timer(self._now + delay, cb)
+        self._timers.add(timer)
         return timer
 
     def add_timer(self, timer):
-        heapq.heappush(self._timers, timer)
+        self._timers.add(timer)
 
     def remove_timer(self, timer):
-        timer.callback = None
-        self._timer_cancels += 1
+        self._timers.remove(timer)
 
     def add_future(self, future, callback):
 
@@ -100,89 +403,181 @@ class IOLoop:
         future.add_done_callback(cb)
 
     def register(self, sock, mode, handler):
+        """register or update `sock`. the mode last passed to kernel is
+        kept, so that re-registering an unchanged mode costs no syscall"""
         fd = sock.fileno()
-        if fd in self._fds:
-            if self._fds[fd][1] != mode:
-                self._impl.modify(fd, mode | self.ERROR)
-            item = list(self._fds[fd])
-            item[2] = handler
-            item[1] = mode
-            self._fds[fd] = tuple(item)
-        else:
-            self._fds[fd] = (sock, mode, handler)
+        fds = self._fds
+        if fd >= len(fds):
+            fds.extend([None] * (fd + 1 - len(fds)))
+        slot = fds[fd]
+        if slot is None or slot[0] is not sock:
+            # fd of a socket closed without unregistering may be reused
+            if slot is not None:
+                self.unregister(slot[0])
+            fds[fd] = [sock, mode, handler, self.IO]
             self._impl.register(fd, mode)
-        return
+            return
+        if slot[1] != mode:
+            self._impl.modify(fd, mode | self.ERROR)
+            slot[1] = mode
+        slot[2] = handler
 
     def unregister(self, sock):
         fd = sock.fileno()
-        self._fds.pop(fd, None)
+        if 0 <= fd < len(self._fds):
+            self._fds[fd] = None
         try:
             self._impl.unregister(fd)
         except Exception as err:
             pass
 
     def mod_register(self, sock, events):
+        slot = self._fds[sock.fileno()]
+        self.register(sock, events, slot[2])
+
+    def set_priority(self, sock, priority: int):
+        """priority class of handler of registered `sock`"""
         fd = sock.fileno()
-        self._impl.modify(fd, events | self.ERROR)
+        slot = self._fds[fd] if 0 <= fd < len(self._fds) else None
+        if slot is not None and slot[0] is sock:
+            slot[3] = priority
 
     def stop(self):
         self._stop = True
-        self._ready = deque()
-        self._timers = list()
-        self._fds = dict()
+        for queue in self._queues:
+            queue.clear()
+        self._timers = self.TIMER_IMPL(self._now)
+        if self._thread_id is None:
+            self._close()
+        # else closed as run returns, the running handler may still register
+
+    def _close(self):
+        self._fds = list()
         self._impl.close()
-        self._timer_cancels = 0
+        self._waker.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self.watchdog is not None:
+            self.watchdog.stop()
+
+    def enable_metrics(self, slow_callback: float=0.1):
+        """time poll waits, callbacks and handlers of this loop. callbacks
+        running longer than `slow_callback` seconds are logged"""
+        from .metrics import LoopMetrics
+        self.metrics = LoopMetrics(slow_callback)
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+
+    def enable_watchdog(self, deadline: float=0.1, interval: float=60):
+        """log stack of the loop thread when an iteration of this loop runs
+        longer than `deadline` seconds, at most once every `interval`"""
+        from .watchdog import Watchdog
+        self.disable_watchdog()
+        self.watchdog = Watchdog(self, deadline, interval)
+        self.watchdog.start()
+        return self.watchdog
+
+    def disable_watchdog(self):
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.watchdog = None
+
+    def run_ready(self, call=None):
+        """run callbacks queued before this call, by priority, until
+        READY_BUDGET is used up. `call(cb)` runs each callback if given"""
+        budget = self.READY_BUDGET
+        deadline = time.monotonic() + budget if budget else None
+        for queue in self._queues:
+            n = len(queue)
+            while n and queue:      # `stop` in a callback clears queues
+                n -= 1
+                cb = queue.popleft()
+                if call is None:
+                    cb()
+                else:
+                    call(cb)
+                if deadline is not None and queue is not self._control \
+                        and time.monotonic() >= deadline:
+                    break
 
-    def run_ready(self):
-        while self._ready:
-            cb = self._ready.popleft()
-            cb()
+    def dispatch(self, events, call=None):
+        """call handlers of polled `events`, those tagged BULK at last.
+        `call(handler, sock, fd, event)` runs each handler if given"""
+        fds, bulk = self._fds, None
+        for fd, event in events:
+            if self._stop:
+                return      # stopped by a handler, epoll is closed
+            slot = fds[fd] if fd < len(fds) else None
+            if slot is None:
+                continue
+            if slot[3] == self.BULK:
+                if bulk is None:
+                    bulk = []
+                bulk.append((slot, fd, event))
+            elif call is None:
+                slot[2](slot[0], fd, event)
+            else:
+                call(slot[2], slot[0], fd, event)
+        if bulk is None:
+            return
+        for slot, fd, event in bulk:
+            if self._stop:
+                return
+            if fd >= len(fds) or fds[fd] is not slot:
+                continue    # unregistered by a handler run before
+            if call is None:
+                slot[2](slot[0], fd, event)
+            else:
+                call(slot[2], slot[0], fd, event)
 
     def check_due_timer(self):
+        self._timers.pop_due(self._now, self._control)
 
-        if self._timers:
-            now = time.time()
-            while self._timers:
-                if self._timers[0].callback is None:
-                    heapq.heappop(self._timers)
-                    self._timer_cancels -= 1
-                elif self._timers[0].due <= now:
-                    self._ready.append(heapq.heappop(self._timers).callback)
-                else:
-                    break
-            
-            if (self._timer_cancels > 512 and 
-                    self._timer_cancels > (len(self._timers) >> 1)):
-                self._timer_cancels = 0
-                self._timers = [t for t in self._timers if t.callback is not None]
-                heapq.heapify(self._timers)
+    def poll_timeout(self) -> float:
+        if self._ready or self._control or self._bulk:
+            return 0
+        due = self._timers.next_due()
+        if due is None:
+            return self.TIMEOUT
+        return min(max(0, due - time.monotonic()), self.TIMEOUT)
 
     def run(self):
+        self._thread_id = threading.get_ident()
+        self._beat += 1
+        self.update_time()
         while not self._stop:
-            if self._ready:
-                self.run_ready()
+            if self.metrics is not None:
+                self.metrics.run_once(self)
+                continue
             self.check_due_timer()
-            timeout = self.TIMEOUT
-            if self._ready:
-                timeout = 0
-            elif self._timers:
-               delta = self._timers[0].due - time.time()
-               timeout = max(0, delta)
-
-            events = self._impl.poll(timeout=timeout)
-            for fd, event in events:
-                sock, mode, handler = self._fds.get(fd, self.DEFAULT_HANDLER)
-                if not sock:
-                    continue
-                handler(sock, fd, event)
+            self.run_ready()
+            if self._stop:
+                break
+            self._beat += 1
+            events = self._impl.poll(timeout=self.poll_timeout())
+            self._beat += 1
+            self.update_time()
+            self.dispatch(events)
+        self._beat += 1
+        self._thread_id = None
+        self._close()
         return None
 
 
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=IOLoop.clear_current)
+
+
 class Timer(object):
 
+    __slots__ = ["due", "callback", "_bucket"]
+
     def __init__(self, due: float, callback):
-        self.due = due
+        self.due = due                  # on clock of IOLoop.time()
         self.callback = callback
+        self._bucket = None             # slot of TimingWheel holding it
 
     def __lt__(self, other):
         return self.due < other.due
@@ -190,25 +585,43 @@ class Timer(object):
     def __le__(self, other):
         return self.due <= other.due
 
-    def register(self):
-        IOLoop.current().add_timer(self)
+    def register(self, loop: IOLoop=None):
+        (loop or IOLoop.current()).add_timer(self)
 
-    def cancel(self):
-        IOLoop.current().remove_timer(self)
+    def cancel(self, loop: IOLoop=None):
+        (loop or IOLoop.current()).remove_timer(self)
 
 
-def sleep(t):
+def sleep(t, loop: IOLoop=None):
     if t <= 0:
-        return sched()
+        return sched(loop)
     future = Future()
-    due = time.time() + t
-    timer = Timer(due, lambda: future.set_result(None))
-    timer.register()
+    loop = loop or IOLoop.current()
+    loop.add_calllater(t, lambda: future.set_result(None))
     return future
 
-def sched():
-    """release CPU and schedule other coroutines to run manually"""
+def sched(loop: IOLoop=None, priority: int=IOLoop.IO):
+    """release CPU and schedule other coroutines to run manually. the
+    coroutine is resumed with callbacks of `priority` class"""
     future = Future()
-    loop = IOLoop.current()
-    loop.add_callsoon(lambda: future.set_result(None))
-    return future    
\ No newline at end of file
+    loop = loop or IOLoop.current()
+    loop.add_callsoon_priority(priority, lambda: future.set_result(None))
+    return future
+
+
+def start_loop_threads(num: int, name: str="micor-loop"):
+    """start `num` threads, each runs its own IOLoop. return the loops,
+    which take work by `add_callsoon_threadsafe`"""
+    loops = list()
+    started = threading.Barrier(num + 1)
+
+    def run():
+        loop = IOLoop.current()
+        loops.append(loop)
+        started.wait()
+        loop.run()
+
+    for i in range(num):
+        threading.Thread(target=run, name="%s-%d" % (name, i), daemon=True).start()
+    started.wait()
+    return loops    
\ No newline at end of file
@@ -0,0 +1,125 @@
+#coding: utf-8
+"""instrumentation of IOLoop, enabled by `IOLoop.enable_metrics`. a loop
+without metrics doesn't run any code of this module"""
+import time
+import logging
+
+
+class Histogram:
+    """latencies in power-of-2 buckets of microseconds"""
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        us = int(seconds * 1000000)
+        self.counts[min(us.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """upper bound of bucket holding the `p` percentile, in seconds"""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min((1 << i) / 1000000.0, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class LoopMetrics:
+    """per iteration histograms of poll wait, ready callbacks, timers and
+    fd handlers, wall time of handlers per handler class, and a log of slow
+    callbacks. handlers don't block, so their wall time is their CPU time"""
+
+    def __init__(self, slow_callback: float=0.1):
+        self.slow_callback = slow_callback
+        self.slow_count = 0
+        self.poll = Histogram()
+        self.ready = Histogram()
+        self.timers = Histogram()
+        self.handlers = Histogram()
+        self.handler_time = dict()      # {class name: [calls, seconds]}
+
+    def _check_slow(self, cb, seconds):
+        if seconds >= self.slow_callback:
+            self.slow_count += 1
+            logging.warn("LOOP: slow callback %r took %.3fs" % (cb, seconds))
+
+    def _call(self, cb):
+        t = time.perf_counter()
+        cb()
+        self._check_slow(cb, time.perf_counter() - t)
+
+    def _call_handler(self, handler, sock, fd, event):
+        t = time.perf_counter()
+        handler(sock, fd, event)
+        cost = time.perf_counter() - t
+        self._check_slow(handler, cost)
+        owner = getattr(handler, "__self__", handler)
+        name = type(owner).__name__
+        acc = self.handler_time.get(name)
+        if acc is None:
+            acc = self.handler_time[name] = [0, 0.0]
+        acc[0] += 1
+        acc[1] += cost
+
+    def run_once(self, loop):
+        """one iteration of `loop.run`, timed"""
+        clock = time.perf_counter
+        start = clock()
+        loop.check_due_timer()
+        t1 = clock()
+        self.timers.add(t1 - start)
+        loop.run_ready(self._call)
+        t2 = clock()
+        self.ready.add(t2 - t1)
+        if loop._stop:
+            return
+
+        loop._beat += 1
+        events = loop._impl.poll(timeout=loop.poll_timeout())
+        loop._beat += 1
+        t3 = clock()
+        self.poll.add(t3 - t2)
+        loop.update_time()
+        loop.dispatch(events, self._call_handler)
+        self.handlers.add(clock() - t3)
+
+    def gauges(self, loop) -> dict:
+        return {
+            "ready": sum(len(queue) for queue in loop._queues),
+            "timers": len(loop._timers),
+            "timers_cancelled": loop._timers.cancelled,
+            "fds": sum(1 for slot in loop._fds if slot is not None),
+        }
+
+    def snapshot(self, loop) -> dict:
+        return {
+            "poll": self.poll.snapshot(),
+            "ready": self.ready.snapshot(),
+            "timers": self.timers.snapshot(),
+            "handlers": self.handlers.snapshot(),
+            "handler_time": {k: tuple(v) for k, v in self.handler_time.items()},
+            "slow_callbacks": self.slow_count,
+            "gauges": self.gauges(loop),
+        }
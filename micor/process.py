@@ -0,0 +1,114 @@
+#coding: utf-8
+"""prefork mode. `fork_processes` is called before any server is created,
+each worker then runs its own IOLoop and binds its own listener with
+SO_REUSEPORT, while the parent supervises workers. on SIGTERM a worker
+stops accepting and finishes its connections before it exits"""
+import os
+import sys
+import signal
+import logging
+
+_task_id = None
+
+# seconds a worker is given on SIGTERM to finish its connections. the
+# parent kills workers still running SHUTDOWN_KILL seconds later
+SHUTDOWN_GRACE = 30
+SHUTDOWN_KILL = 5
+
+_stopping = False
+
+
+def task_id():
+    """index of current worker, None if processes are not forked"""
+    return _task_id
+
+
+def _start_child(i, children: dict) -> bool:
+    pid = os.fork()
+    if pid == 0:
+        global _task_id
+        _task_id = i
+        signal.signal(signal.SIGTERM, _on_child_term)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        return True
+    children[pid] = i
+    return False
+
+
+def _on_child_term(signum, frame):
+    global _stopping
+    if _stopping:
+        return
+    _stopping = True
+    from .ioloop import IOLoop
+    from .handler import shutdown
+    logging.info("PROCESS: worker %d stopping" % _task_id)
+    # a signal handler may interrupt the loop anywhere, so shut down
+    # from a callback of the loop
+    IOLoop.current().add_callsoon_threadsafe(shutdown, SHUTDOWN_GRACE)
+
+
+def fork_processes(num: int=0, max_restarts: int=100) -> int:
+    """fork `num` workers, cpu count if 0. index of the worker is returned
+    in the child. parent never returns, it restarts workers which crash,
+    and terminates all workers on SIGTERM or SIGINT, then exits after
+    all of them exited"""
+    assert _task_id is None, "processes already forked"
+    if num <= 0:
+        num = os.cpu_count() or 1
+    logging.info("PROCESS: start %d workers" % num)
+
+    children = dict()   # {pid: task_id}
+    for i in range(num):
+        if _start_child(i, children):
+            return i
+
+    stopping = []
+
+    def kill(sig):
+        for pid in children:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def on_signal(signum, frame):
+        if not stopping:
+            signal.alarm(SHUTDOWN_GRACE + SHUTDOWN_KILL)
+        stopping.append(signum)
+        kill(signal.SIGTERM)
+
+    def on_alarm(signum, frame):
+        logging.warn("PROCESS: %d workers still running, kill them" % len(children))
+        kill(signal.SIGKILL)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGALRM, on_alarm)
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        i = children.pop(pid, None)
+        if i is None or stopping:
+            continue
+        if os.WIFSIGNALED(status):
+            logging.warn("PROCESS: worker %d (pid %d) killed by signal %d" % (
+                i, pid, os.WTERMSIG(status)))
+        elif os.WEXITSTATUS(status):
+            logging.warn("PROCESS: worker %d (pid %d) exited with status %d" % (
+                i, pid, os.WEXITSTATUS(status)))
+        else:
+            logging.info("PROCESS: worker %d (pid %d) exited" % (i, pid))
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError("too many worker restarts, give up")
+        if _start_child(i, children):
+            return i
+    signal.alarm(0)
+    sys.exit(0)
@@ -0,0 +1,165 @@
+#coding: utf-8
+"""profiler of coroutines run by `Task`. while enabled, every step of a
+Task created in the meantime is timed: CPU time between suspensions,
+number of suspensions, time spent waiting per type of future, and wall
+time of the whole coroutine. a task is accounted under the path of tasks
+which created it, so `collapsed` gives stacks for flame graph tools"""
+import time
+import threading
+from .gen import Task
+
+_task_step = Task._step
+
+
+def _qualname(gen) -> str:
+    code = getattr(gen, "gi_code", None) or getattr(gen, "cr_code", None)
+    if code is None:
+        return type(gen).__name__
+    return getattr(code, "co_qualname", code.co_name)
+
+
+def _await_chain(gen) -> list:
+    """names of generators and coroutines `gen` waits for in turn"""
+    names = []
+    gen = getattr(gen, "gi_yieldfrom", None) or getattr(gen, "cr_await", None)
+    while gen is not None:
+        name = _qualname(gen)
+        if name != "Future.__await__":
+            names.append(name)
+        gen = getattr(gen, "gi_yieldfrom", None) or getattr(gen, "cr_await", None)
+    return names
+
+
+class CoroutineProfiler:
+    """`stats` maps name of a coroutine to [tasks, steps, suspensions,
+    cpu, wall, wait], times in seconds. `waits` maps type of future to
+    [count, seconds] waited. CPU time of a step excludes steps of other
+    tasks run inside it, such as a task created or woken up by it"""
+
+    # a profiler replaces Task._step, so only one is enabled at a time
+    _enabled = None
+
+    def __init__(self):
+        self.stats = dict()     # {coroutine name: [tasks, steps, suspensions, cpu, wall, wait]}
+        self.waits = dict()     # {future type: [count, seconds]}
+        self.stacks = dict()    # {collapsed stack: cpu seconds}
+        self._tasks = dict()    # {task: [path, stats, created, suspended, future type]}
+        self._local = threading.local()
+
+    def enable(self):
+        assert CoroutineProfiler._enabled is None, "a profiler is enabled already"
+        CoroutineProfiler._enabled = self
+        Task._step = _profiled_step
+        return self
+
+    def disable(self):
+        if CoroutineProfiler._enabled is self:
+            CoroutineProfiler._enabled = None
+            Task._step = _task_step
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def _running(self) -> list:
+        """[task state, cpu of nested steps] of steps running in this thread"""
+        running = getattr(self._local, "running", None)
+        if running is None:
+            running = self._local.running = []
+        return running
+
+    def _start(self, task, now, running) -> list:
+        name = _qualname(task._gen)
+        path = running[-1][0][0] + ";" + name if running else name
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0, 0, 0, 0.0, 0.0, 0.0]
+        stats[0] += 1
+        state = self._tasks[task] = [path, stats, now, None, None]
+        return state
+
+    def step(self, task, value=None):
+        clock, cpu_clock = time.perf_counter, time.thread_time
+        running = self._running()
+        now = clock()
+        state = self._tasks.get(task)
+        if state is None:
+            state = self._start(task, now, running)
+        elif state[3] is not None:
+            waited = now - state[3]
+            state[1][5] += waited
+            acc = self.waits.get(state[4])
+            if acc is None:
+                acc = self.waits[state[4]] = [0, 0.0]
+            acc[0] += 1
+            acc[1] += waited
+
+        frame = [state, 0.0]
+        running.append(frame)
+        cpu = cpu_clock()
+        try:
+            fut = _task_step(task, value)
+        finally:
+            cpu = cpu_clock() - cpu
+            running.pop()
+        if running:
+            running[-1][1] += cpu
+        cpu -= frame[1]
+        end = clock()
+
+        stats = state[1]
+        stats[1] += 1
+        stats[3] += cpu
+        gen = task._gen
+        if gen is None:     # finished
+            del self._tasks[task]
+            stats[4] += end - state[2]
+            stack = state[0]
+        else:
+            stats[2] += 1
+            state[3] = end
+            state[4] = type(fut).__name__ if fut is not None else "IOLoop"
+            stack = ";".join([state[0]] + _await_chain(gen))
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + cpu
+        return fut
+
+    def collapsed(self) -> str:
+        """one `stack microseconds` line per stack, the format of
+        flamegraph.pl and speedscope"""
+        return "".join("%s %d\n" % (stack, cpu * 1000000)
+                       for stack, cpu in sorted(self.stacks.items()) if cpu > 0)
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+
+    def snapshot(self) -> dict:
+        return {
+            "coroutines": {
+                name: {
+                    "tasks": s[0], "steps": s[1], "suspensions": s[2],
+                    "cpu": s[3], "wall": s[4], "wait": s[5],
+                } for name, s in self.stats.items()
+            },
+            "waits": {k: tuple(v) for k, v in self.waits.items()},
+            "pending": len(self._tasks),
+        }
+
+    def report(self, limit: int=20) -> str:
+        """coroutines taking most CPU, as a table"""
+        lines = ["%-40s %8s %8s %8s %10s %10s" % (
+            "coroutine", "tasks", "steps", "suspends", "cpu", "wait")]
+        top = sorted(self.stats.items(), key=lambda item: -item[1][3])
+        for name, s in top[:limit]:
+            lines.append("%-40s %8d %8d %8d %10.6f %10.6f" % (
+                name[-40:], s[0], s[1], s[2], s[3], s[5]))
+        return "\n".join(lines)
+
+
+def _profiled_step(task, value=None):
+    profiler = CoroutineProfiler._enabled
+    if profiler is None:    # task created while a profiler was enabled
+        return _task_step(task, value)
+    return profiler.step(task, value)
@@ -0,0 +1,101 @@
+#coding:utf-8
+import time
+from collections import OrderedDict
+
+
+class DNSCache:
+    """answers keyed by (hostname, qtype). an answer expires after the
+    smallest TTL of its records, clamped into [MIN_TTL, MAX_TTL]. at most
+    `maxsize` answers are kept, the least recently used is evicted first.
+    an empty answer (NXDOMAIN or no record of qtype) is kept NEGATIVE_TTL
+    seconds, an error answered by every server (e.g. SERVFAIL) FAILURE_TTL
+    seconds. neither replaces an answer which isn't expired yet. a query
+    nobody answered is not cached at all.
+
+    an answer hit HOT_HITS times within its TTL is hot. a hit on a hot
+    answer past REFRESH_AT of its TTL calls `on_refresh(host, qtype)`
+    once, so that the owner can query it again before it expires. hits
+    are counted from zero for each new answer, so a name stays hot only
+    while it's asked in every TTL period"""
+
+    MIN_TTL = 5
+    MAX_TTL = 3600
+    NEGATIVE_TTL = 30
+    FAILURE_TTL = 3
+
+    HOT_HITS = 3
+    REFRESH_AT = 0.9
+
+    def __init__(self, maxsize: int=4096, clock=time.monotonic):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._entries = OrderedDict()   # {(hostname, qtype): [expire, ips, refresh, hits]}
+        self.on_refresh = None
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host: bytes, qtype: int):
+        """ips cached for `host`, an empty list if the name is known not
+        to resolve, None if there is no usable answer"""
+        key = (host, qtype)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = self._clock()
+        if entry[0] <= now:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        if not entry[1]:
+            self.negative_hits += 1
+            return entry[1]
+        self.hits += 1
+        entry[3] += 1
+        if entry[2] <= now and entry[3] >= self.HOT_HITS \
+                and self.on_refresh is not None:
+            entry[2] = entry[0]     # once per answer
+            self.refreshes += 1
+            self.on_refresh(host, qtype)
+        return entry[1]
+
+    def set(self, host: bytes, qtype: int, ips: list, ttl: int):
+        ttl = min(max(ttl, self.MIN_TTL), self.MAX_TTL)
+        now = self._clock()
+        self._put((host, qtype), [now + ttl, ips, now + ttl * self.REFRESH_AT, 0])
+
+    def set_negative(self, host: bytes, qtype: int, failed: bool=False):
+        now = self._clock()
+        old = self._entries.get((host, qtype))
+        if old is not None and old[1] and old[0] > now:
+            return
+        expire = now + (self.FAILURE_TTL if failed else self.NEGATIVE_TTL)
+        self._put((host, qtype), [expire, [], expire, 0])
+
+    def _put(self, key, entry):
+        entries = self._entries
+        entries[key] = entry
+        entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "refreshes": self.refreshes,
+        }
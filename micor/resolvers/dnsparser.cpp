@@ -127,6 +127,7 @@ static PyObject* _class_attrs(){
 	PyDict_SetItem(d, PyUnicode_FromString("QTYPE_CNAME"), PyLong_FromLong(QTYPE_CNAME));
 	PyDict_SetItem(d, PyUnicode_FromString("QTYPE_AAAA"), PyLong_FromLong(QTYPE_AAAA));
 	PyDict_SetItem(d, PyUnicode_FromString("QTYPE_ANY"), PyLong_FromLong(QTYPE_ANY));
+	PyDict_SetItem(d, PyUnicode_FromString("QTYPE_OPT"), PyLong_FromLong(QTYPE_OPT));
 	PyDict_SetItem(d, PyUnicode_FromString("QCLASS_IN"), PyLong_FromLong(QCLASS_IN));
 	return d;
 }
@@ -181,7 +182,7 @@ static unsigned short short_from_resp(DNSParser* self) {
 
 //从resp中解析出长度值(int), 并移动offset
 static unsigned int int_from_resp(DNSParser* self) {
-	register unsigned short res = unpacki(self->data->ob_sval + self->offset);
+	register unsigned int res = unpacki(self->data->ob_sval + self->offset);
 	self->offset += 4;
 	return res;
 }
@@ -250,9 +251,9 @@ DNSParser_build_request(DNSParser* self, PyObject *args){
 	register char c = DNS_REQ_HEADER_LEN, e = 0;
 	register char part_len = 0;
 	
-	unsigned short qtype = 0, id = 0, qcls = 0;
+	unsigned short qtype = 0, id = 0, qcls = 0, payload = 0;
 
-	if (!PyArg_ParseTuple(args, "SHH", &dn, &qtype, &id)){
+	if (!PyArg_ParseTuple(args, "SHH|H", &dn, &qtype, &id, &payload)){
 		return NULL;
 	}
 
@@ -267,6 +268,8 @@ DNSParser_build_request(DNSParser* self, PyObject *args){
 
 	register char s = 0;
 	register size_t size = DNS_REQ_SIZE(b->ob_base.ob_size);
+	if (payload)
+		size += DNS_OPT_LEN;
 
 	PyBytesObject* req = (PyBytesObject*)PyBytes_FromSize(size, 0);
 	if (req == NULL)
@@ -293,6 +296,17 @@ DNSParser_build_request(DNSParser* self, PyObject *args){
 	*(req->ob_sval + c) = 0;	//\x00
 	memcpy(req->ob_sval + c + 1, &qtype, 2);
 	memcpy(req->ob_sval + c + 3, &qcls, 2);
+	if (payload){
+		//EDNS0 OPT record in additional section: root name, type, udp payload size as class,
+		//extended rcode and flags as ttl, no rdata
+		char* opt = req->ob_sval + size - DNS_OPT_LEN;
+		unsigned short opt_type = htons(QTYPE_OPT);
+		payload = htons(payload);
+		memset(opt, 0, DNS_OPT_LEN);
+		memcpy(opt + 1, &opt_type, 2);
+		memcpy(opt + 3, &payload, 2);
+		req->ob_sval[11] = 1;		//ARCOUNT
+	}
 	req->ob_sval[size] = '\0';
 	return (PyObject*)req;
 }
@@ -307,16 +321,31 @@ DNSParser_parse_rrs(DNSParser* self, PyObject* rrs, size_t n){
 	register unsigned int ttl = 0;
 	for (size_t i = 0; i < n; i++){
 		
-		PyObject* domain = DNSParser_parse_domain(self);
+		PyObject* domain = NULL;
+		if (GET_BYTE(self->data, self->offset) == DOMAIN_END){
+			domain = PyBytes_FromStringAndSize("", 0);	//root, owner of OPT record
+			self->offset += 1;
+		}
+		else{
+			domain = DNSParser_parse_domain(self);
+		}
+		if (domain == NULL)
+			return NULL;
 
 		qtype = short_from_resp(self);
 		qcls = short_from_resp(self);
 		ttl = int_from_resp(self);
 		data_length = short_from_resp(self);
 		register PyObject* ip = NULL;
+		unsigned int rdata_end = self->offset + data_length;
 
-		if (qtype != QTYPE_A && qtype != QTYPE_AAAA){
+		if (qtype == QTYPE_CNAME || qtype == QTYPE_NS){
 			ip = DNSParser_parse_domain(self);
+			self->offset = rdata_end;
+		}
+		else if (qtype != QTYPE_A && qtype != QTYPE_AAAA){
+			ip = PyBytes_FromStringAndSize(d + self->offset, data_length);	//raw rdata, e.g. of OPT or SOA
+			self->offset = rdata_end;
 		}
 		else{
 			int af = 0;
@@ -400,9 +429,11 @@ PyDoc_STRVAR(parse_domain_doc,
 	parse domain name from `data`. it will modify `offset` field");
 
 PyDoc_STRVAR(build_request_doc,
-	"build_request(hostname: bytes, qtype: int, tid: int) -> bytes\n\
+	"build_request(hostname: bytes, qtype: int, tid: int, payload: int=0) -> bytes\n\
 	\n\
 	build DNS request package with hostname and qtype with transaction id.\n\
+	an EDNS0 OPT record advertising `payload` bytes of UDP is appended if\n\
+	`payload` is not 0.\n\
 	\n\
 	type of `hostname` must be bytes; transaction id must be a short int, \n\
 	which can be generated by `os.urandom(2)`; and qtype must be one of \n\
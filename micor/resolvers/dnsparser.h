@@ -42,12 +42,14 @@ unsigned int unpacki(char* buf);
 #define DNS_REQ_HEADER_LEN 12
 #define DNS_REQ_TAIL_LEN 5
 #define MAX_DNS_PART_LEN 63
+#define DNS_OPT_LEN 11
 
 #define QTYPE_A 1
 #define QTYPE_NS 2
 #define QTYPE_CNAME 5
 #define QTYPE_AAAA 28
 #define QTYPE_ANY 255
+#define QTYPE_OPT 41
 #define QCLASS_IN 1
 
 #define DNS_REQ_SIZE(domain_len) (DNS_REQ_HEADER_LEN + \
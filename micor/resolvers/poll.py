@@ -1,10 +1,11 @@
 #coding:utf-8
-import os, socket, sys, struct, logging
-import time
+import os, socket, struct, logging
+import weakref
 from micor import IOLoop, Future, coroutine
+from micor.gen import with_timeout, wait_any
 from micor.utils import ip_type
-from micor.sync import Queue, Empty
-from .dnsparser import DNSParser, RR
+from .dnsparser import DNSParser
+from .cache import DNSCache
 from micor import errors, utils
 
 
@@ -44,9 +45,152 @@ class NamedList:
         container[hostname] = l
 
 
+class NameServer:
+    """round trip estimate and failure count of a nameserver. the
+    retransmission timeout is estimated as TCP does (RFC 6298)"""
+
+    RTO_INIT = 0.5
+    RTO_MIN = 0.1
+    RTO_MAX = 3
+
+    def __init__(self, addr: str):
+        self.addr = addr
+        self.srtt = None
+        self.rttvar = 0.0
+        self.failures = 0       # queries unanswered in a row
+
+    def on_answer(self, rtt=None):
+        """`rtt` is None if it's ambiguous, after a retransmission"""
+        self.failures = 0
+        if rtt is None:
+            return
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def on_failure(self):
+        self.failures += 1
+
+    @property
+    def rto(self) -> float:
+        if self.srtt is None:
+            return self.RTO_INIT
+        return min(max(self.srtt + 4 * self.rttvar, self.RTO_MIN), self.RTO_MAX)
+
+    @property
+    def score(self) -> float:
+        """expected time to get an answer, lower is better. each failure
+        in a row doubles it"""
+        return self.rto * (1 << min(self.failures, 10))
+
+
+class Query:
+    """an outstanding query, shared by lookups of the same host and qtype.
+    `sent` keeps the time a server was queried, None if it was queried
+    more than once"""
+
+    __slots__ = ["host", "qtype", "tid", "future", "expire", "retry",
+                 "attempts", "last", "sent", "tcp"]
+
+    def __init__(self, host: bytes, qtype: int, tid: int):
+        self.host = host
+        self.qtype = qtype
+        self.tid = tid
+        self.future = Future()
+        self.expire = None      # timer giving the query up
+        self.retry = None       # timer of next transmission
+        self.attempts = 0
+        self.last = None        # server of last transmission
+        self.sent = dict()      # {server: time sent}
+        self.tcp = False        # answer was truncated, ask over TCP
+
+
+class TCPChannel:
+    """TCP connection to a nameserver, for answers truncated over UDP.
+    queries are pipelined on it, each prefixed by its length, answers
+    are passed to resolver in whatever order they arrive. it's closed
+    after IDLE seconds without an answer"""
+
+    IDLE = 10
+    CONNECT_TIMEOUT = 5
+
+    def __init__(self, resolver, addr: tuple):
+        self.addr = addr
+        self._resolver = resolver
+        self._conn = None       # TCPClient once connected
+        self._queued = []       # requests sent before connected
+        self._task = None
+        self._closed = False
+
+    def send(self, req: bytes):
+        if self._closed:
+            return      # the query is retransmitted on a new channel
+        data = struct.pack("!H", len(req)) + req
+        if self._conn is not None:
+            self._conn.write(data)
+            return
+        self._queued.append(data)
+        if self._task is None:
+            self._task = self._run()
+
+    @coroutine
+    def _run(self):
+        from micor.handler import TCPClient
+        conn = TCPClient(self._resolver._loop)
+        try:
+            yield conn.connect(self.addr, timeout=self.CONNECT_TIMEOUT)
+            self._conn = conn
+            for data in self._queued:
+                conn.write(data)
+            self._queued = []
+            while True:
+                head = yield conn.read_nbytes(2, timeout=self.IDLE)
+                data = yield conn.read_nbytes(struct.unpack("!H", head)[0], timeout=self.IDLE)
+                self._resolver.on_read(data, self.addr, tcp=True)
+        except (errors.ConnectionClosed, errors.TimeoutError, OSError) as exc:
+            logging.debug("DNS: tcp connection to %s closed: %r" % (self.addr[0], exc))
+        finally:
+            self.close()
+            if conn._sock is not None:
+                conn.close()
+
+    def close(self):
+        self._closed = True
+        if self._resolver._tcp.get(self.addr[0]) is self:
+            del self._resolver._tcp[self.addr[0]]
+
+
 class AsyncResolver:
     FAMILY_ALL = 0
 
+    DNS_PORT = 53
+
+    # seconds a lookup waits for answers, if it's given no timeout
+    TIMEOUT = 10
+
+    # UDP payload advertised with EDNS0, larger answers are truncated and
+    # asked again over TCP. 1232 avoids IP fragmentation on most paths
+    EDNS_PAYLOAD = 1232
+
+    # a query is sent again if it's not answered within RTO of the server,
+    # to the next server by score. the delay doubles after every round of
+    # all servers, up to RETRY_MAX
+    RETRY_MAX = 4
+
+    # hot names are queried again in background before their answers
+    # expire, see DNSCache. at most PREFETCH_RATE queries per second, in
+    # bursts of PREFETCH_BURST. 0 to disable
+    PREFETCH_RATE = 10
+    PREFETCH_BURST = 20
+    PREFETCH_TIMEOUT = 5
+
+    # a lookup of both A and AAAA returns this long after the first
+    # answer at most, the other query goes on and fills the cache. it's
+    # the resolution delay of RFC 8305
+    RESOLUTION_DELAY = 0.05
+
     _FAMILY2QTYPE = {
         socket.AF_INET: DNSParser.QTYPE_A,
         socket.AF_INET6: DNSParser.QTYPE_AAAA,
@@ -63,10 +207,18 @@ class AsyncResolver:
         self._hosts_v6 = dict()
 
         self._host = NamedList()
-        self._resolved = NamedList()
-        self._queues = dict()          # {transaction_id: queue}
+        self._cache = DNSCache()
+        self._cache.on_refresh = self._prefetch
+        self._prefetch_tokens = self.PREFETCH_BURST
+        self._prefetch_time = 0
+        self.prefetches = 0
+        self.prefetch_dropped = 0     # refreshes over PREFETCH_RATE
+        self._queries = dict()         # {transaction_id: Query}
+        self._inflight = dict()        # {(hostname, qtype): Query}
 
         self._dnsservers = list()
+        self._servers = dict()         # {address: NameServer}
+        self._tcp = dict()             # {address: TCPChannel}
         self._sock = self.create_sock()
         if not loop:
             loop = IOLoop.current()
@@ -75,6 +227,17 @@ class AsyncResolver:
         self.parse_resolv()
         self.register(self._loop.READ, self.handle)
 
+    def reinit(self, loop=None):
+        """take a new socket and loop, e.g. in a forked child, whose
+        socket and loop are inherited from parent"""
+        self._sock.close()
+        self._queries = dict()
+        self._inflight = dict()
+        self._tcp = dict()
+        self._sock = self.create_sock()
+        self._loop = loop or IOLoop.current()
+        self.register(self._loop.READ, self.handle)
+
     def register(self, events=None, cb=None):
         if self._sock._closed:
             return
@@ -142,113 +305,244 @@ class AsyncResolver:
         future = Future()
         res = dict()        # family: [iplist]
         family = ip_type(host)
+        missing = 0
         if family:
             qtype = self._FAMILY2QTYPE[family]
             res = {qtype: [host]}
         else:
-            res = self._resolved.get(host, qtype)
+            for qt in NamedList.ALL_QTYPE:
+                if qt & qtype:
+                    ips = self._cache.get(host, qt)
+                    if ips is None:
+                        missing |= qt
+                    elif ips:
+                        res[qt] = ips
 
-        # for qt in res:
-        #     qtype ^= qt     # 检查是否还缺少v4或者v6
+        # a cached empty answer counts as hit, it fails without a query
+        qtype = 0 if res else missing     # 只要命中缓存，就不查询DNS，不管是否缺少v4/v6
         
-        qtype = 0 if res else qtype     # 只要命中缓存，就不查询DNS，不管是否缺少v4/v6
-        
-        self._loop.add_callsoon(lambda: future.set_result((res, qtype)))
+        future.set_result((res, qtype))
         return future
 
     def _transaction_id(self):
-        return struct.unpack("!H", os.urandom(2))[0]
+        while True:
+            tid = struct.unpack("!H", os.urandom(2))[0]
+            if tid not in self._queries:
+                return tid
 
-    def _send_req(self, host: bytes, tid: int, qtype: int):
+    def _send_req(self, host: bytes, tid: int, qtype: int, server: str, tcp: bool=False):
+        if not tcp:
+            req = DNSParser.build_request(host, qtype, tid, self.EDNS_PAYLOAD)
+            self._sock.sendto(req, (server, self.DNS_PORT))
+            return
         req = DNSParser.build_request(host, qtype, tid)
-        # for server in self._dnsservers:
-        #     self._sock.sendto(req, (server, 53))
-        self._sock.sendto(req, (self._dnsservers[0], 53))
+        channel = self._tcp.get(server)
+        if channel is None:
+            channel = self._tcp[server] = TCPChannel(self, (server, self.DNS_PORT))
+        channel.send(req)
+
+    def _server(self, addr: str) -> NameServer:
+        server = self._servers.get(addr)
+        if server is None:
+            server = self._servers[addr] = NameServer(addr)
+        return server
+
+    def servers(self) -> list:
+        """configured nameservers, the preferred first"""
+        return sorted((self._server(addr) for addr in self._dnsservers),
+                      key=lambda server: server.score)
+
+    def _query(self, host: bytes, qtype: int, timeout: float) -> Future:
+        """future of ips of `host`, None if query failed. concurrent
+        lookups of the same host and qtype share one query, which is
+        given up after the latest `timeout` of them"""
+        key = (host, qtype)
+        query = self._inflight.get(key)
+        if query is not None:
+            due = self._loop.time() + timeout
+            if query.expire is not None and query.expire.due < due:
+                self._loop.remove_timer(query.expire)
+                query.expire = self._loop.add_calllater(timeout, lambda: self._expire(query))
+            return query.future
+        query = Query(host, qtype, self._transaction_id())
+        query.expire = self._loop.add_calllater(timeout, lambda: self._expire(query))
+        self._inflight[key] = query
+        self._queries[query.tid] = query
+        self._transmit(query)
+        return query.future
+
+    def _transmit(self, query: Query, server: NameServer=None):
+        """send `query` to `server`, or next server. servers not asked yet
+        are raced in order of score, each one after RTO of the previous one"""
+        servers = self.servers()
+        if server is None:
+            untried = [server for server in servers if server not in query.sent]
+            server = untried[0] if untried else servers[query.attempts % len(servers)]
+        backoff = 1 << min(query.attempts // len(servers), 5)
+        query.attempts += 1
+        query.last = server
+        query.sent[server] = self._loop.time() if server not in query.sent else None
+        try:
+            self._send_req(query.host, query.tid, query.qtype, server.addr, query.tcp)
+        except OSError as exc:
+            logging.warn("DNS: send query to %s failed: %s" % (server.addr, exc))
+        delay = min(server.rto * backoff, self.RETRY_MAX)
+        query.retry = self._loop.add_calllater(delay, lambda: self._retransmit(query))
+
+    def _retransmit(self, query: Query):
+        query.retry = None
+        if self._queries.get(query.tid) is not query:
+            return
+        query.last.on_failure()
+        self._transmit(query)
+
+    def _finish(self, query: Query, ips):
+        if self._inflight.get((query.host, query.qtype)) is query:
+            del self._inflight[(query.host, query.qtype)]
+        self._queries.pop(query.tid, None)
+        for timer in (query.expire, query.retry):
+            if timer is not None:
+                self._loop.remove_timer(timer)
+        query.expire = query.retry = None
+        query.future.set_result(ips)
+
+    def _expire(self, query: Query):
+        # no server answered, which says nothing about the name, so it's
+        # not cached and the next lookup asks again
+        query.expire = None
+        if self._queries.get(query.tid) is query:
+            self._finish(query, None)
+
+    def _prefetch(self, host: bytes, qtype: int):
+        """query `host` again, its cached answer is refreshed by the response"""
+        if not self.PREFETCH_RATE or (host, qtype) in self._inflight:
+            return
+        now = self._loop.time()
+        self._prefetch_tokens = min(self.PREFETCH_BURST, self._prefetch_tokens
+                + (now - self._prefetch_time) * self.PREFETCH_RATE)
+        self._prefetch_time = now
+        if self._prefetch_tokens < 1:
+            self.prefetch_dropped += 1
+            return
+        self._prefetch_tokens -= 1
+        self.prefetches += 1
+        logging.debug("DNS: prefetch %s" % host)
+        self._query(host, qtype, self.PREFETCH_TIMEOUT)
+
+    def _wait_query(self, host: bytes, qtype: int, timeout: float) -> Future:
+        """future of a lookup waiting for the shared query, it is
+        cancelled with TimeoutError after `timeout`, the query goes on"""
+        query = self._query(host, qtype, timeout)
+        waiter = Future()
+
+        def on_answer(fut):
+            if not waiter.done():
+                waiter.set_result(fut._result)
+
+        query.add_done_callback(on_answer)
+        waiter.add_done_callback(lambda f: query.remove_done_callback(on_answer))
+        return with_timeout(waiter, timeout, self._loop)
 
     @coroutine
     def getaddrinfo(self, 
             host: str, port: int, 
             family: int=0, type: int=0, 
             proto: int=0, flags: int=0,
-            timeout: int=10):
+            timeout: int=0):
+        timeout = timeout or self.TIMEOUT
         qtype = self._FAMILY2QTYPE[family]
         bhost = host.encode("utf-8")
         typed_ips, qtype = yield self._addr_from_cache(bhost, qtype)
         if qtype:
-            qsize = 0
-            tid = self._transaction_id()
-            if qtype & DNSParser.QTYPE_A:
-                self._send_req(bhost, tid, DNSParser.QTYPE_A)
-                qsize += 1
-            if qtype & DNSParser.QTYPE_AAAA:
-                self._send_req(bhost, tid, DNSParser.QTYPE_AAAA)
-                qsize += 1
-            
-            queue = Queue(maxsize=qsize)
-            self._queues[tid] = queue
-            while qsize:
-                if timeout < 0:
-                    self._queues.pop(tid, None)
-                    raise errors.TimeoutError()
-                start = time.time()
-                resolved = None
-                try:
-                    resolved = yield queue.get(timeout=timeout) # {qtype: ips}
-                    timeout -= (time.time() - start)
-                except Empty:
-                    pass
-                except Exception as exc:
-                    logging.warn("DNS: %s" % exc)
-                finally:
-                    qsize -= 1
-                if resolved is None:
-                    logging.warn("DNS: %s resolve failed" % host)
-                else:
-                    typed_ips.update(resolved)
-            self._queues.pop(tid, None)
+            # queries of all qtypes are sent before waiting for any of them,
+            # answers are taken in the order they arrive
+            waiters = {self._wait_query(bhost, qt, timeout): qt
+                       for qt in NamedList.ALL_QTYPE if qt & qtype}
+            delayed = False
+            while waiters:
+                waiter = yield wait_any(*waiters)
+                qt = waiters.pop(waiter)
+                if waiter._exc_info is None and waiter._result:
+                    typed_ips[qt] = waiter._result
+                if typed_ips and waiters and not delayed:
+                    delayed = True
+                    for waiter in waiters:
+                        with_timeout(waiter, self.RESOLUTION_DELAY, self._loop)
         else:
             logging.debug("DNS: [hit cache] %s" % host)
 
         if not typed_ips:
+            logging.warn("DNS: %s resolve failed" % host)
             raise socket.gaierror("getaddrinfo failed: %s" % host)
         res = []
-        for qt, ips in typed_ips.items():
+        for qt in NamedList.ALL_QTYPE:
+            ips = typed_ips.get(qt)
+            if not ips:
+                continue
             fm = self._QTYPE2FAMILY[qt]
             res += [(fm, type, proto, "", (utils.tostr(ip), port)) for ip in ips]
         return res
 
-    def on_read(self, data: bytes):
+    def on_read(self, data: bytes, addr=None, tcp: bool=False):
+        """`tcp` tells an answer read from a TCPChannel from a datagram"""
         tid = struct.unpack("!H", data[:2])[0]
-        queue = self._queues.get(tid, None)
-        if not queue:
-            logging.warn("DNS: no wait queue found, but received a response with transaction id %d" % tid)
+        query = self._queries.get(tid, None)
+        if not query:
+            logging.warn("DNS: no query found, but received a response with transaction id %d" % tid)
             return
+        server = None
+        if addr is not None:
+            server = self._servers.get(addr[0])
+            if server not in query.sent:
+                return      # not from a server queried, spoofed or stale
+        if not tcp:
+            if query.tcp:
+                return      # asked over TCP already, the answer comes from there
+            if data[2] & 0x02:      # TC, truncated
+                query.tcp = True
+                if query.retry is not None:
+                    self._loop.remove_timer(query.retry)
+                self._transmit(query, server or query.last)
+                return
         try:
-            hostname, qtype, rrs = DNSParser(data).parse_response()
+            _, _, rrs = DNSParser(data).parse_response()
         except Exception as e:
             logging.warn("DNS: parse dns response error: %s" % str(e), exc_info=True)
-            queue.put(None)
+            self._on_server_failure(query, server)
             return
 
-        ipv4s, ipv6s = list(), list()
+        ips, ttl = list(), DNSCache.MAX_TTL
         for rr in rrs:
-            if rr.qtype == DNSParser.QTYPE_A and rr.qcls == DNSParser.QCLASS_IN:
-                ipv4s.append(rr.value)
-
-            elif rr.qtype == DNSParser.QTYPE_AAAA and rr.qcls == DNSParser.QCLASS_IN:
-                ipv6s.append(rr.value)
-
-        item = None
-        if qtype & DNSParser.QTYPE_A:
-            if ipv4s:
-                self._resolved.set_list(hostname, ipv4s, DNSParser.QTYPE_A)
-                item = {DNSParser.QTYPE_A: ipv4s}
-            queue.put(item)
-        if qtype & DNSParser.QTYPE_AAAA:
-            if ipv6s:
-                self._resolved.set_list(hostname, ipv6s, DNSParser.QTYPE_AAAA)
-                item = {DNSParser.QTYPE_AAAA: ipv6s}
-            queue.put(item)
+            if rr.qtype == query.qtype and rr.qcls == DNSParser.QCLASS_IN:
+                ips.append(rr.value)
+                ttl = min(ttl, rr.ttl)
+
+        if not ips and (data[3] & 0x0f) not in (0, 3):     # neither NOERROR nor NXDOMAIN
+            self._on_server_failure(query, server)
+            return
+        if server is not None:
+            sent = query.sent[server]
+            server.on_answer(self._loop.time() - sent if sent is not None else None)
+        if ips:
+            self._cache.set(query.host, query.qtype, ips, ttl)
+        else:
+            self._cache.set_negative(query.host, query.qtype)
+        self._finish(query, ips)
+
+    def _on_server_failure(self, query: Query, server):
+        """a server answered with an error, or garbage. other servers are
+        asked at once, the query fails if all of them were asked already.
+        the error is cached for FAILURE_TTL, so that a broken zone isn't
+        asked again by every lookup"""
+        if server is not None:
+            server.on_failure()
+        if query.attempts < len(self._dnsservers):
+            if query.retry is not None:
+                self._loop.remove_timer(query.retry)
+            self._transmit(query)
+        else:
+            self._cache.set_negative(query.host, query.qtype, failed=True)
+            self._finish(query, None)
 
     def handle(self, sock, fd, events):
         if events & self._loop.ERROR:
@@ -257,13 +551,36 @@ class AsyncResolver:
             return
         if events & self._loop.READ:
             try:
-                data, _ = self._sock.recvfrom(65535)
-                self.on_read(data)
+                data, addr = self._sock.recvfrom(65535)
+                self.on_read(data, addr)
             except Exception as exc:
                 logging.warn(exc, exc_info=True)
             
     def close(self):
         pass
 
+    def cache_stats(self) -> dict:
+        """size and hit/miss counters of the answer cache, and counters
+        of prefetch"""
+        stats = self._cache.stats()
+        stats["prefetches"] = self.prefetches
+        stats["prefetch_dropped"] = self.prefetch_dropped
+        return stats
+
+
+resolver = AsyncResolver()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=resolver.reinit)
+
+_loop_resolvers = weakref.WeakKeyDictionary()     # {loop: resolver} of other loops
 
-resolver = AsyncResolver()
\ No newline at end of file
+def get_resolver(loop=None):
+    """resolver running in `loop`, created at first use for loops other
+    than the one of `resolver`"""
+    loop = loop or IOLoop.current()
+    if loop is resolver._loop:
+        return resolver
+    res = _loop_resolvers.get(loop)
+    if res is None:
+        res = _loop_resolvers[loop] = AsyncResolver(loop)
+    return res
\ No newline at end of file
@@ -17,14 +17,14 @@ class Lock:
         future = Future()
         if not self._locked:
             self._locked = True
-            self._loop.add_callsoon(lambda f: f.set_result(True), future)
+            future.set_result(True)
         else:
             self._waiters.append(future)
         return future
 
     def release(self):
         future = Future()
-        self._loop.add_callsoon(lambda f: f.set_result(True), future)
+        future.set_result(True)
         self._locked = bool(self._waiters)
         if self._waiters:
             fut = self._waiters.popleft()
@@ -34,8 +34,8 @@ class Lock:
 
 class Queue:
 
-    def __init__(self, maxsize=0):
-        self._loop = IOLoop.current()
+    def __init__(self, maxsize=0, loop: IOLoop=None):
+        self._loop = loop or IOLoop.current()
         self._items = deque()
         self._item_count = 0
         self._maxsize = maxsize
@@ -69,7 +69,7 @@ class Queue:
         if self._item_count > 0:
             item = self._items.popleft()
             self._item_count -= 1
-            self._loop.add_callsoon(lambda: future.set_result(item))
+            future.set_result(item)
             if self._put_waiters:
                 self._wakeup_first_putter()
             return future
@@ -101,13 +101,13 @@ class Queue:
 
         if self._get_waiters:
             self._wakeup_first_getter(item)
-            self._loop.add_callsoon(lambda: future.set_result(None))
+            future.set_result(None)
             return future
         
         if not self.full():
             self._items.append(item)
             self._item_count += 1
-            self._loop.add_callsoon(lambda: future.set_result(None))
+            future.set_result(None)
             return future
 
         if not block:
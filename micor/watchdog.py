@@ -0,0 +1,97 @@
+#coding: utf-8
+"""detection of a blocked IOLoop, enabled by `IOLoop.enable_watchdog`.
+the loop bumps its `_beat` counter before and after each poll, so the
+counter is odd while the loop runs callbacks and handlers. a thread
+checks the counter, and reports stack of the loop thread when it stays
+at the same odd value longer than the deadline"""
+import sys
+import time
+import logging
+import threading
+import traceback
+from inspect import CO_GENERATOR, CO_COROUTINE
+
+
+class Watchdog:
+    """reports an iteration of `loop` running longer than `deadline`
+    seconds, at most one report every `interval` seconds, others are
+    only counted"""
+
+    def __init__(self, loop, deadline: float=0.1, interval: float=60):
+        self.deadline = deadline
+        self.interval = interval
+        self.stalls = 0         # iterations over the deadline
+        self.suppressed = 0     # stalls not reported since last report
+        self._loop = loop
+        self._last_report = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._watch, name="micor-watchdog", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _watch(self):
+        loop = self._loop
+        period = self.deadline / 2
+        beat, since = -1, 0.0
+        while not self._stopped.wait(period):
+            now = time.monotonic()
+            current = loop._beat
+            if current != beat:
+                beat, since = current, now
+                continue
+            if not beat & 1 or since is None:
+                continue    # polling, or reported already
+            if now - since >= self.deadline:
+                self.stalls += 1
+                self._report(now - since)
+                since = None
+
+    def _report(self, elapsed: float):
+        now = time.monotonic()
+        if self._last_report is not None \
+                and now - self._last_report < self.interval:
+            self.suppressed += 1
+            return
+        self._last_report = now
+        frame = sys._current_frames().get(self._loop._thread_id)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame))
+        logging.warn(
+            "LOOP: blocked over %.3fs in %s, coroutine %s, %d stalls not "
+            "reported\n%s" % (elapsed, self.running_handler(frame),
+            self.running_coroutine(frame), self.suppressed, stack))
+        self.suppressed = 0
+
+    @staticmethod
+    def running_coroutine(frame) -> str:
+        """innermost generator or coroutine on stack of `frame`"""
+        while frame is not None:
+            if frame.f_code.co_flags & (CO_GENERATOR | CO_COROUTINE):
+                return _describe(frame)
+            frame = frame.f_back
+        return "-"
+
+    @staticmethod
+    def running_handler(frame) -> str:
+        """callback or fd handler called by the loop on stack of `frame`"""
+        from .ioloop import IOLoop
+        from .metrics import LoopMetrics
+        loops = (IOLoop.run_ready.__code__, IOLoop.dispatch.__code__,
+                 LoopMetrics._call.__code__, LoopMetrics._call_handler.__code__)
+        while frame is not None and frame.f_back is not None:
+            if frame.f_back.f_code in loops:
+                return _describe(frame)
+            frame = frame.f_back
+        return "-"
+
+
+def _describe(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return "%s (%s:%d)" % (name, code.co_filename, frame.f_lineno)
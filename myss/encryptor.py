@@ -1,12 +1,124 @@
 #coding: utf-8
+import os
+import hashlib
 
-from .parser import rc4
+from .parser import RC4
 
 
-def encrypt(text: bytes, key: bytes) -> bytes:
-    return rc4(text, key)
+class RC4Cipher:
+    """plain RC4 stream, the key is used as it is"""
 
+    IV_LEN = 0
 
+    def __init__(self, key: bytes, iv: bytes):
+        self._ctx = RC4(key)
 
-def decrypt(text: bytes, key: bytes) -> bytes:
-    return rc4(text, key)
\ No newline at end of file
+    def update(self, text: bytes) -> bytes:
+        return self._ctx.update(text)
+
+    def update_into(self, buf) -> int:
+        return self._ctx.update_into(buf)
+
+
+class RC4MD5Cipher(RC4Cipher):
+    """RC4 keyed by md5(key + iv), so that each stream owns its keystream"""
+
+    IV_LEN = 16
+
+    def __init__(self, key: bytes, iv: bytes):
+        self._ctx = RC4(hashlib.md5(key + iv).digest())
+
+
+_ciphers = {}
+
+def register_cipher(name: str, cls):
+    """register a cipher class by `name`. `cls(key, iv)` must return an object
+    with methods `update(text: bytes) -> bytes` and `update_into(buf) -> int`,
+    the latter transforms a writable buffer in place. `cls.IV_LEN` is length
+    of the IV sent ahead of the stream"""
+    _ciphers[name] = cls
+
+def get_cipher(name: str):
+    try:
+        return _ciphers[name]
+    except KeyError:
+        raise ValueError("unknown cipher method: %s" % name)
+
+register_cipher("rc4", RC4Cipher)
+register_cipher("rc4-md5", RC4MD5Cipher)
+
+
+class Encryptor:
+    """encrypt side of a stream. keystream state is kept across chunks,
+    and the IV, if any, is sent ahead of the first chunk"""
+
+    def __init__(self, method: str, key: bytes):
+        cls = get_cipher(method)
+        self._iv = os.urandom(cls.IV_LEN)
+        self._cipher = cls(key, self._iv)
+
+    def encrypt(self, text: bytes) -> bytes:
+        res = self._cipher.update(text)
+        if self._iv:
+            res = self._iv + res
+            self._iv = b''
+        return res
+
+    def encrypt_into(self, buf) -> bytes:
+        """encrypt writable `buf` in place. return the IV which must be sent
+        ahead of `buf`, it's empty except for the first call"""
+        self._cipher.update_into(buf)
+        iv, self._iv = self._iv, b''
+        return iv
+
+
+class Decryptor:
+    """decrypt side of a stream. the IV, if any, is taken from the head of
+    the stream, so `decrypt` may return less bytes than it is given"""
+
+    def __init__(self, method: str, key: bytes):
+        self._cls = get_cipher(method)
+        self._key = key
+        self._iv = b''
+        self._cipher = None
+        if not self._cls.IV_LEN:
+            self._cipher = self._cls(key, b'')
+
+    @property
+    def iv_len(self) -> int:
+        """bytes of IV still expected from the stream"""
+        return self._cls.IV_LEN - len(self._iv) if self._cipher is None else 0
+
+    def decrypt(self, text: bytes) -> bytes:
+        if self._cipher is None:
+            need = self.iv_len
+            self._iv += text[:need]
+            text = text[need:]
+            if self.iv_len:
+                return b''
+            self._cipher = self._cls(self._key, self._iv)
+        return self._cipher.update(text)
+
+    def decrypt_into(self, buf) -> memoryview:
+        """decrypt writable `buf` in place, such as the receive buffer of a
+        connection. return a view of `buf` which holds the plain text"""
+        view = memoryview(buf)
+        if self._cipher is None:
+            need = self.iv_len
+            self._iv += bytes(view[:need])
+            view = view[need:]
+            if self.iv_len:
+                return view
+            self._cipher = self._cls(self._key, self._iv)
+        self._cipher.update_into(view)
+        return view
+
+
+def encrypt(text: bytes, key: bytes, method: str="rc4-md5") -> bytes:
+    """encrypt a whole message, such as an udp package"""
+    return Encryptor(method, key).encrypt(text)
+
+
+def decrypt(text: bytes, key: bytes, method: str="rc4-md5") -> bytes:
+    """decrypt a whole message, such as an udp package"""
+    return Decryptor(method, key).decrypt(text)
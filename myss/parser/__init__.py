@@ -4,6 +4,59 @@ import struct
 from typing import List, Tuple
 
 from .cares import rc4
+from ..logger import logger
+
+try:
+    from .cares import RC4
+except ImportError:
+    logger.warning("cares has no RC4, falling back to pure-Python RC4 which "
+                   "is much slower, rebuild the extension to fix it")
+
+    class RC4:
+        """stateful RC4 cipher context. key schedule runs once, and the keystream
+        continues across calls of `update`. create one context for each
+        direction of a stream"""
+
+        __slots__ = ["_s", "_i", "_j"]
+
+        def __init__(self, key: bytes):
+            if not key:
+                raise RuntimeError("key is an empty bytes object")
+            s = list(range(256))
+            j, klen = 0, len(key)
+            for i in range(256):
+                j = (j + s[i] + key[i % klen]) & 0xff
+                s[i], s[j] = s[j], s[i]
+            self._s = s
+            self._i = self._j = 0
+
+        def update(self, text: bytes) -> bytes:
+            """en/decrypt `text` with the next len(text) bytes of keystream"""
+            out = bytearray(text)
+            self.update_into(out)
+            return bytes(out)
+
+        def update_into(self, buf) -> int:
+            """en/decrypt `buf` in place with the next len(buf) bytes of keystream,
+            no new object is allocated. return number of bytes transformed"""
+            s, i, j = self._s, self._i, self._j
+            view = memoryview(buf).cast("B")
+            for n in range(len(view)):
+                i = (i + 1) & 0xff
+                j = (j + s[i]) & 0xff
+                s[i], s[j] = s[j], s[i]
+                view[n] ^= s[(s[i] + s[j]) & 0xff]
+            self._i, self._j = i, j
+            return len(view)
+
+try:
+    from .cares import rc4_into
+except ImportError:
+
+    def rc4_into(buf, key: bytes) -> int:
+        """RC4 en/decrypt `buf` in place, such as a bytearray or a memoryview
+        slice of it. return number of bytes transformed"""
+        return RC4(key).update_into(buf)
 
 try:
     from .cares import RR
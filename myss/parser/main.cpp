@@ -3,6 +3,7 @@
 
 static PyMethodDef module_methods[] = {
 	{ "rc4", (PyCFunction)PyRC4, METH_VARARGS, PyRC4_doc },
+	{ "rc4_into", (PyCFunction)PyRC4_into, METH_VARARGS, PyRC4_into_doc },
 	{ "parse_socks5_header", (PyCFunction)parse_socks5_header, METH_O, parse_socks5_header_doc },
 	{ "build_ping_pkg", (PyCFunction)PyBuild_ping_pkg, METH_VARARGS, bpp_doc },
 	{ "parse_ping_pkg", (PyCFunction)PyParse_ping_pkg, METH_O, ppp_doc},
@@ -26,7 +27,8 @@ PyInit_cares(void){
 	if (PyType_Ready(&RRType) < 0 ||
 		PyType_Ready(&DNSParserType) < 0 ||
 		PyType_Ready(&SocksHeaderType) < 0 ||
-		PyType_Ready(&PyICMPFrameType) < 0){
+		PyType_Ready(&PyICMPFrameType) < 0 ||
+		PyType_Ready(&RC4Type) < 0){
 		return NULL;
 	}
 
@@ -36,5 +38,7 @@ PyInit_cares(void){
 	PyModule_AddObject(m, "DNSParser", (PyObject*)&DNSParserType);
 	PyModule_AddObject(m, "SocksHeader", (PyObject*)&SocksHeaderType);
 	PyModule_AddObject(m, "ICMPFrame", (PyObject*)&PyICMPFrameType);
+	Py_INCREF(&RC4Type);
+	PyModule_AddObject(m, "RC4", (PyObject*)&RC4Type);
 	return m;
 }
\ No newline at end of file
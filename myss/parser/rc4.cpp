@@ -39,3 +39,138 @@ PyRC4(PyObject* mod, PyObject* op){
 	return d;
 }
 
+
+PyObject*
+PyRC4_into(PyObject* mod, PyObject* op){
+	Py_buffer buf;
+	PyObject* k = NULL;
+	if (!PyArg_ParseTuple(op, "w*S", &buf, &k)){
+		return NULL;
+	}
+	unsigned char* key = (unsigned char*)((PyBytesObject*)k)->ob_sval;
+	size_t klen = ((PyBytesObject*)k)->ob_base.ob_size;
+	if (klen <= 0){
+		PyBuffer_Release(&buf);
+		PyErr_SetString(PyExc_RuntimeError, "key is an empty bytes object");
+		return NULL;
+	}
+	unsigned char* data = (unsigned char*)buf.buf;
+	Py_ssize_t dlen = buf.len;
+	if (dlen > 0){
+		RC4(key, klen, data, dlen);
+	}
+	PyBuffer_Release(&buf);
+	return PyLong_FromSsize_t(dlen);
+}
+
+static int
+RC4Object_init(RC4Object* self, PyObject *args, PyObject *kwds){
+	PyObject* k = NULL;
+	if (!PyArg_ParseTuple(args, "S", &k)){
+		return -1;
+	}
+	unsigned char* key = (unsigned char*)((PyBytesObject*)k)->ob_sval;
+	size_t klen = ((PyBytesObject*)k)->ob_base.ob_size;
+	if (klen <= 0){
+		PyErr_SetString(PyExc_RuntimeError, "key is an empty bytes object");
+		return -1;
+	}
+	for (int n = 0; n < SBOX_LEN; n++){
+		self->s[n] = (unsigned char)n;
+	}
+	MESS_SBOX(self->s, key, klen)
+	self->i = 0;
+	self->j = 0;
+	return 0;
+}
+
+static void
+rc4_stream(RC4Object* self, unsigned char* data, Py_ssize_t len){
+	unsigned char* s = self->s;
+	unsigned char i = self->i, j = self->j;
+	for (Py_ssize_t c = 0; c < len; c++){
+		i = (unsigned char)(i + 1);
+		j = (unsigned char)(j + s[i]);
+		SWAP_BYTE(s[i], s[j])
+		data[c] ^= s[(unsigned char)(s[i] + s[j])];
+	}
+	self->i = i;
+	self->j = j;
+}
+
+static PyObject*
+RC4Object_update(RC4Object* self, PyObject* op){
+	Py_buffer buf;
+	if (PyObject_GetBuffer(op, &buf, PyBUF_SIMPLE) < 0){
+		return NULL;
+	}
+	PyObject* d = PyBytes_FromSize(buf.len, 0);
+	if (d == NULL){
+		PyBuffer_Release(&buf);
+		return PyErr_NoMemory();
+	}
+	unsigned char* dc = (unsigned char*)(((PyBytesObject*)d)->ob_sval);
+	memcpy(dc, buf.buf, buf.len);
+	rc4_stream(self, dc, buf.len);
+	PyBuffer_Release(&buf);
+	return d;
+}
+
+static PyObject*
+RC4Object_update_into(RC4Object* self, PyObject* op){
+	Py_buffer buf;
+	if (PyObject_GetBuffer(op, &buf, PyBUF_WRITABLE) < 0){
+		return NULL;
+	}
+	Py_ssize_t dlen = buf.len;
+	rc4_stream(self, (unsigned char*)buf.buf, dlen);
+	PyBuffer_Release(&buf);
+	return PyLong_FromSsize_t(dlen);
+}
+
+static PyMethodDef RC4Object_methods[] = {
+	{ "update", (PyCFunction)RC4Object_update, METH_O, RC4_update_doc },
+	{ "update_into", (PyCFunction)RC4Object_update_into, METH_O, RC4_update_into_doc },
+	{ NULL }
+};
+
+PyTypeObject RC4Type = {
+	PyVarObject_HEAD_INIT(NULL, 0)	//PyObject_VAR_HEAD
+	"cares.RC4",					//tp_name,
+	sizeof(RC4Object),				//tp_basicsize
+	0,								//tp_itemsize
+	0,								//tp_dealloc
+	0,								//tp_print
+	0,								//tp_getattr
+	0,								//tp_setattr
+	0,								//tp_as_async
+	0,								//tp_repr
+	0,								//tp_as_number
+	0,								//tp_as_sequence
+	0,								//tp_as_mapping
+	0,								//tp_hash
+	0,								//tp_call
+	0,								//tp_str,
+	0,								//tp_getattro
+	0,								//tp_setattro
+	0,								//tp_as_buffer
+	Py_TPFLAGS_DEFAULT,				//tp_flags
+	RC4Type_doc,					//tp_doc
+	0,								//tp_traverse
+	0,								//tp_clear
+	0,								//tp_richcompare
+	0,								//tp_weaklistoffset
+	0,								//tp_iter
+	0,								//tp_iternext
+	RC4Object_methods,				//tp_methods
+	0,								//tp_members
+	0,								//tp_getset
+	0,								//tp_base
+	0,								//tp_dict
+	0,								//tp_descr_get
+	0,								//tp_descr_set
+	0,								//tp_dictoffset
+	(initproc)RC4Object_init,		//tp_init
+	0,								//tp_alloc
+	PyType_GenericNew				//tp_new
+};
@@ -50,6 +50,18 @@
 }
 
 PyObject* PyRC4(PyObject* mod, PyObject* op);
+PyObject* PyRC4_into(PyObject* mod, PyObject* op);
+
+
+//stateful RC4 context, keystream continues across calls of `update`
+typedef struct {
+	PyObject_HEAD
+	unsigned char s[SBOX_LEN];
+	unsigned char i;
+	unsigned char j;
+} RC4Object;
+
+extern PyTypeObject RC4Type;
 
 
 PyDoc_STRVAR(PyRC4_doc,
@@ -57,5 +69,29 @@ PyDoc_STRVAR(PyRC4_doc,
 	\n\
 	RC4 en/decryptor");
 
+PyDoc_STRVAR(PyRC4_into_doc,
+	"rc4_into(buf: writable buffer, key: bytes) -> int\n\
+	\n\
+	RC4 en/decrypt `buf` in place, such as a bytearray or a memoryview\n\
+	slice of it. return number of bytes transformed");
+
+PyDoc_STRVAR(RC4Type_doc,
+	"RC4(key: bytes) -> RC4 object\n\
+	\n\
+	stateful RC4 cipher context. key schedule runs once, and the keystream\n\
+	continues across calls of `update`. create one context for each\n\
+	direction of a stream");
+
+PyDoc_STRVAR(RC4_update_doc,
+	"update(text: bytes-like) -> bytes\n\
+	\n\
+	en/decrypt `text` with the next len(text) bytes of keystream");
+
+PyDoc_STRVAR(RC4_update_into_doc,
+	"update_into(buf: writable buffer) -> int\n\
+	\n\
+	en/decrypt `buf` in place with the next len(buf) bytes of keystream,\n\
+	no new object is allocated. return number of bytes transformed");
+
 
 #endif
\ No newline at end of file
@@ -1,14 +1,14 @@
 import struct
-import os
 import socket
 import logging
+import time
 from functools import lru_cache
 from . import encryptor, pac, socks5
 
 from micor import TCPClient, coroutine, \
     Connection, IOLoop, Datagram, UDPClient
-from micor import errors, utils
-from micor.resolvers.poll import resolver
+from micor import errors
+from micor.resolvers.poll import get_resolver
 
 local_addr = "127.0.0.1"
 local_port = 1080
@@ -17,12 +17,16 @@ server_addr = "127.0.0.1"
 server_port = 8850
 
 key = b'123456'
+# cipher of relayed data, both sides must agree. "rc4-md5" sends a random
+# IV ahead of each stream, so that flows don't share a keystream. plain
+# "rc4" reuses one keystream for every flow, it's only for testing
+method = "rc4-md5"
 
 @lru_cache(100)
-def udp_client(host, port, family):
+def udp_client(host, port, family, loop=None):
     sock = socket.socket(family, socket.SOCK_DGRAM)
     sock.setblocking(False)
-    client = UDPClient(sock, (host, port))
+    client = UDPClient(sock, (host, port), loop)
     return client
 
 
@@ -37,19 +41,27 @@ class TCPRelayBase(Connection):
 
     LOCAL = False
 
+    TIMEOUT = 60
+
+    half_close = True
+
     def __init__(self, sock, addr, loop):
         super().__init__(sock, addr, loop)
         self.peer = None
-        self.encryptor = encryptor
+        self._last_active = 0
+        self.method = method
+        self._encryptor = None      # cipher contexts of this flow, created at SYN
+        self._decryptor = None
         self.pac = pac.rules
-        self.resolver = resolver
+        self.resolver = get_resolver(self._loop)
         self.is_peer_direct = not self.LOCAL    # 与peer是否直连, server肯定是直连, local要看情况
                                                 # 在pac中的就不是直连, 不在的就是直连
 
     @coroutine
     def create_peer(self, host: str, port: int, atyp: int):
         addr = (host, port)
-        conn = TCPClient()
+        conn = TCPClient(self._loop)
+        conn.half_close = True
         yield conn.connect(addr)
         logging.debug("TCP: create tcp connect to %s:%d" % addr)
         self.peer = conn
@@ -93,9 +105,16 @@ class TCPRelayBase(Connection):
         n = yield self.write(resp)
         return n
 
+    def create_ciphers(self):
+        """one cipher context for each direction, keystream continues
+        across chunks until the flow ends"""
+        self._encryptor = encryptor.Encryptor(self.method, key)
+        self._decryptor = encryptor.Decryptor(self.method, key)
+
     @coroutine
     def syn(self):
         try:
+            self.create_ciphers()
             sks, chunk = yield self.parse_header()
             if self.LOCAL:
                 n = yield self.write(socks5.ack(local_addr, local_port))   # send sck
@@ -106,9 +125,7 @@ class TCPRelayBase(Connection):
             yield self.create_peer(svr[0], svr[1], sks.atyp)    # 连到目标服务器, 可能是代理, 也可能是真正的服务器
 
             if not self.is_peer_direct:                         # 如果连的是代理, 那么要发送syn信息
-                n = yield self.peer.write(
-                    self.encryptor.encrypt(chunk, key)
-                )
+                n = yield self.peer.write(self._encryptor.encrypt(chunk))
             return True
         except CmdUDPForward:
             n = yield self.send_udpfwd_ack()
@@ -138,30 +155,84 @@ class TCPRelayBase(Connection):
             self.close()
             return
         logging.debug("TCP: SYN complete with {:15s}:{:5d}".format(*self.peer._addr))
-        while True:
-            try:
-                chunk = yield self.read_forever(timeout=60)
-                logging.debug("TCP: recv {:6d} B from {:15s}:{:5d}".format(len(chunk), *self._addr))
-                if self.need_dencrypt():        
-                    chunk = self.encryptor.encrypt(chunk, key)      # 这里encrypt==decrypt
+        # relayed data yields to handshakes of new flows, DNS and timers
+        self.set_priority(IOLoop.BULK)
+        self.peer.set_priority(IOLoop.BULK)
 
-                n = yield self.peer.write(chunk)
-                logging.debug("TCP: send {:6d} B to   {:15s}:{:5d}".format(n, *self.peer._addr))
-
-                resp = yield self.peer.read_forever(timeout=60)
-                logging.debug("TCP: recv {:6d} B from {:15s}:{:5d}".format(len(resp), *self.peer._addr))
+        upstream_cipher = downstream_cipher = None
+        if self.need_dencrypt():
+            if self.LOCAL:
+                upstream_cipher = self.encrypt_into
+                downstream_cipher = self._decryptor.decrypt_into
+            else:
+                upstream_cipher = self._decryptor.decrypt_into
+                downstream_cipher = self.encrypt_into
+
+        self._last_active = time.time()
+        upstream = self.pump(self, self.peer, upstream_cipher)          # client -> peer
+        downstream = self.pump(self.peer, self, downstream_cipher)      # peer -> client
+        for future in (upstream, downstream):
+            if not future.done():
+                yield future
+        for conn in (self, self.peer):
+            try:
+                yield conn.drain(timeout=self.TIMEOUT)  # close discards unsent data
+            except (errors.ConnectionClosed, errors.TimeoutError,
+                    socket.error, IOError, OSError):
+                pass
+        self.close()
+        self.peer.close()
 
-                if self.need_dencrypt():
-                    resp = self.encryptor.decrypt(resp, key)        # 这里encrypt==decrypt
-                
-                n = yield self.write(resp)
-                logging.debug("TCP: send {:6d} B to   {:15s}:{:5d}".format(n, *self._addr))
+    def encrypt_into(self, chunk: memoryview):
+        iv = self._encryptor.encrypt_into(chunk)
+        return iv + chunk if iv else chunk
 
+    @coroutine
+    def pump(self, src: Connection, dst: Connection, cipher=None):
+        """copy data from `src` to `dst` until `src` sends FIN, the other
+        direction keeps running. Each direction is pumped by its own coroutine,
+        so the relay is full-duplex. `cipher` en/decrypts each chunk in place
+        if given"""
+        eof = False
+        while True:
+            try:
+                # chunk is a view of src's read buffer, which keeps valid until
+                # next read. it's not read again before dst sends chunk out
+                chunk = yield src.read_forever(timeout=self.TIMEOUT, copy=False)
+                logging.debug("TCP: recv {:6d} B from {:15s}:{:5d}".format(len(chunk), *src._addr))
+                self._last_active = time.time()
+                if cipher:
+                    chunk = cipher(chunk)
+                    if not chunk:
+                        continue        # only IV received
+                n = yield dst.write(chunk)
+                logging.debug("TCP: send {:6d} B to   {:15s}:{:5d}".format(n, *dst._addr))
+            except errors.TimeoutError:
+                if time.time() - self._last_active < self.TIMEOUT:
+                    continue        # the other direction is still busy
+                logging.warn("TCP: relay with {:15s}:{:5d} timeout".format(*self._addr))
+                break
             except errors.ConnectionClosed as exc:
-                logging.warn("TCP: relay chain broken by {:15s}:{:5d}".format(*exc.by))
-                self.close()
-                self.peer.close()
+                eof = src._eof and not dst._closed     # half close, pass FIN to dst
+                if not eof:
+                    logging.warn("TCP: relay chain broken by {:15s}:{:5d}".format(*exc.by))
                 break
+            except (socket.error, IOError, OSError) as exc:
+                logging.warn("TCP: relay chain broken: %s" % exc)
+                break
+        if eof:
+            try:
+                # FIN must follow the data still buffered in dst
+                yield dst.drain(timeout=self.TIMEOUT)
+                dst.shutdown_write()
+                return
+            except errors.TimeoutError:
+                logging.warn("TCP: relay with {:15s}:{:5d} timeout".format(*self._addr))
+            except (errors.ConnectionClosed, socket.error, IOError, OSError) as exc:
+                logging.warn("TCP: relay chain broken: %s" % exc)
+        # abort the whole chain, the other pump will be woken up by `close`
+        src.close()
+        dst.close()
 
     def nego_response(self):
         return b'\x05\x00'
@@ -169,6 +240,8 @@ class TCPRelayBase(Connection):
     @coroutine
     def parse_header(self):
         n = 8 if self.LOCAL else 5
+        if not self.LOCAL:
+            n += self._decryptor.iv_len
         chunk = yield self.read_nbytes(n, timeout=60)
         if self.LOCAL:
             cmd = chunk[1]
@@ -180,12 +253,11 @@ class TCPRelayBase(Connection):
             else:
                 raise RuntimeError("unknown socks5 command: %d" % cmd)
         else:
-            chunk = self.encryptor.decrypt(chunk, key)
+            chunk = self._decryptor.decrypt(chunk)
         h = socks5.parse_socks5_header(chunk)
         chunkpart = yield self.read_nbytes(0 - h.header_length, 20)
         if not self.LOCAL:
-            tmp = os.urandom(n) + chunkpart
-            chunkpart = self.encryptor.decrypt(tmp, key)[n:]
+            chunkpart = self._decryptor.decrypt(chunkpart)
         chunk += chunkpart
         sks = socks5.parse_socks5_header(chunk)
         return sks, chunk
@@ -217,9 +289,9 @@ class SocksUDPRelay(Datagram):
             loop = IOLoop.current()
         super().__init__(sock, addr, data, loop)
         self.peer = None
-        self.encryptor = encryptor
+        self.method = method
         self.pac = pac.rules
-        self.resolver = resolver
+        self.resolver = get_resolver(self._loop)
         self.is_direct = False
 
     def get_server(self, host: str, port: int):
@@ -231,7 +303,7 @@ class SocksUDPRelay(Datagram):
         info = yield self.resolver.getaddrinfo(host, port, family)
         af, _, _, _, sa = info[0]
         logging.debug("UDP: %s resolved into %s" % (host, sa[0]))
-        self.peer = udp_client(sa[0], sa[1], af)
+        self.peer = udp_client(sa[0], sa[1], af, self._loop)
         return self.peer
 
     @coroutine
@@ -263,7 +335,7 @@ class SocksUDPLocalRelay(SocksUDPRelay):
         svr_addr = self.get_server(dest_addr, sks.dest_port)
 
         if dest_addr in self.pac:
-            data = self.encryptor.encrypt(data, key)
+            data = encryptor.encrypt(data, key, self.method)
         else:
             data = data[sks.header_length:]
 
@@ -276,7 +348,7 @@ class SocksUDPLocalRelay(SocksUDPRelay):
         if not res: return
         
         if dest_addr in self.pac:
-            data = self.encryptor.decrypt(data, key)
+            data = encryptor.decrypt(res, key, self.method)
             res = b'\x00\x00\x00' + data
 
         self.write_package(res)     # send back to client
@@ -294,7 +366,7 @@ class SocksUDPServerRelay(SocksUDPRelay):
     def relay(self):
         data = self.read_package()      # recv from local
         
-        data = self.encryptor.decrypt(data, key)    # decrypt
+        data = encryptor.decrypt(data, key, self.method)    # decrypt
         sks = socks5.parse_socks5_header(data)      # parse protocol
 
         if sks.dest_port == 0: raise RuntimeError("fail")
@@ -314,9 +386,9 @@ class SocksUDPServerRelay(SocksUDPRelay):
         if len(self._addr[0]) > 255: raise RuntimeError("bad addr")
 
         data = socks5.pack_addr(self._addr[0]) + \
-            struct.pack("!H", self._addr[1]) + data
+            struct.pack("!H", self._addr[1]) + res
 
-        res = self.encryptor.encrypt(data, key)     # encrypt response of target server
+        res = encryptor.encrypt(data, key, self.method)     # encrypt response of target server
 
         self.write_package(res)     # send back to local
         logging.debug("UDP: send {:6d} B to   {:15s}:{:5d} ".format(
@@ -1,10 +1,11 @@
 #coding:utf-8
-import os, socket, sys, struct, logging
+import os, socket, logging
 from micor import BaseHandler, IOLoop, Future, coroutine
+from micor.gen import with_timeout
+from micor.resolvers.cache import DNSCache
 from micor.utils import ip_type
-from .parser import DNSParser, RR
+from .parser import DNSParser
 from .logger import logger
-from micor import errors
 
 class AsyncResolver(BaseHandler):
 
@@ -17,8 +18,7 @@ class AsyncResolver(BaseHandler):
     def __init__(self, loop=None):
         self._hosts_v4 = dict()
         self._hosts_v6 = dict()
-        self._resolved_v4 = dict()  # {hostname: iplist}
-        self._resolved_v6 = dict()
+        self._cache = DNSCache()
         self._futures_v4 = dict()      # {hostname: futurelist}
         self._futures_v6 = dict()      # {hostname: futurelist}
         self._dnsservers = list()
@@ -30,6 +30,15 @@ class AsyncResolver(BaseHandler):
         self.parse_resolv()
         self.register(self._loop.READ, self.handle)
 
+    def reinit(self, loop=None):
+        """take a new socket and loop, e.g. in a forked child, whose
+        socket and loop are inherited from parent"""
+        self._sock.close()
+        self._futures_v4, self._futures_v6 = dict(), dict()
+        self._sock = self.create_sock()
+        self._loop = loop or IOLoop.current()
+        self.register(self._loop.READ, self.handle)
+
     def create_sock(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.SOL_UDP)
         s.setblocking(False)
@@ -84,19 +93,21 @@ class AsyncResolver(BaseHandler):
             self._dnsservers = ['8.8.4.4', '8.8.8.8']
 
     def resolve_from_cache(self, host, qtype):
+        """ips of `host`, an empty list if it's known not to resolve,
+        None if it has to be queried. ips of A and AAAA are merged if both
+        are asked, a known answer of either one saves the query"""
         if ip_type(host):
             return [host]
 
-        ips = list()
-        if qtype & DNSParser.QTYPE_A:
-            ips = self._hosts_v4.get(host)
-            if not ips:
-                ips = self._resolved_v4.get(host)
-        if qtype & DNSParser.QTYPE_AAAA:
-            ips = self._hosts_v6.get(host)
-            if not ips:
-                ips = self._resolved_v6.get(host)
-        return ips
+        res = None
+        for qt, hosts in ((DNSParser.QTYPE_A, self._hosts_v4),
+                          (DNSParser.QTYPE_AAAA, self._hosts_v6)):
+            if not qtype & qt:
+                continue
+            ips = hosts.get(host) or self._cache.get(host, qt)
+            if ips is not None:
+                res = (res or []) + ips
+        return res
 
     def _send_req(self, host: bytes, qtype: int):
         req = DNSParser.build_request(host, qtype)
@@ -116,28 +127,21 @@ class AsyncResolver(BaseHandler):
         qtype = self._FAMILY2QTYPE[family]
         host = host.encode("utf-8")
         ips = self.resolve_from_cache(host, qtype)
-        timer = None
-        if ips:
+        if ips is not None:
             logger.debug("DNS: hit cache: %s" % host.decode("utf8"))
-            self._loop.add_callsoon(lambda f: f.set_result(None), future)
-            yield future
         else:
             if timeout:
-                timer = self._loop.add_calllater(
-                    timeout, 
-                    lambda: future.cancel(errors.TimeoutError, None, None))
+                with_timeout(future, timeout, self._loop)
             if qtype & DNSParser.QTYPE_A:
                 self._send_req(host, DNSParser.QTYPE_A)
                 self._add_to_container(self._futures_v4, host, future)
             if qtype & DNSParser.QTYPE_AAAA:
                 self._send_req(host, DNSParser.QTYPE_AAAA)
                 self._add_to_container(self._futures_v6, host, future)
-            ips = yield future
-        if timer:
-            self._loop.remove_timer(timer)
+            ips = yield future     # a timeout isn't cached, next call retries
         if not ips:
             raise socket.gaierror("getaddrinfo failed: %s" % host)
-        res = [(family, type, proto, "", (ip, port)) for ip in ips]
+        res = [(family or ip_type(ip), type, proto, "", (ip, port)) for ip in ips]
         return res
 
     def on_read(self, data: bytes):
@@ -147,15 +151,27 @@ class AsyncResolver(BaseHandler):
             logging.warn("DNS: parse dns response error: %s" % str(e), exc_info=True)
             return
         ipv4s, ipv6s = list(), list()
+        ttl4 = ttl6 = DNSCache.MAX_TTL
         for rr in rrs:
             if rr.qtype == DNSParser.QTYPE_A and rr.qcls == DNSParser.QCLASS_IN:
                 ipv4s.append(rr.value)
+                ttl4 = min(ttl4, rr.ttl)
             elif rr.qtype == DNSParser.QTYPE_AAAA and rr.qcls == DNSParser.QCLASS_IN:
                 ipv6s.append(rr.value)
-        self._resolved_v4[hostname] = ipv4s
-        self._resolved_v6[hostname] = ipv6s
+                ttl6 = min(ttl6, rr.ttl)
+        failed = (data[3] & 0x0f) not in (0, 3)     # neither NOERROR nor NXDOMAIN
         v4_futures = self._futures_v4.pop(hostname, [])
         v6_futures = self._futures_v6.pop(hostname, [])
+        # the response doesn't tell its qtype, an empty answer is only
+        # cached for the qtype which is waited for
+        if ipv4s:
+            self._cache.set(hostname, DNSParser.QTYPE_A, ipv4s, ttl4)
+        elif v4_futures:
+            self._cache.set_negative(hostname, DNSParser.QTYPE_A, failed)
+        if ipv6s:
+            self._cache.set(hostname, DNSParser.QTYPE_AAAA, ipv6s, ttl6)
+        elif v6_futures:
+            self._cache.set_negative(hostname, DNSParser.QTYPE_AAAA, failed)
         for future in v4_futures:
             future.set_result(ipv4s)
         for future in v6_futures:
@@ -176,5 +192,11 @@ class AsyncResolver(BaseHandler):
     def close(self):
         pass
 
+    def cache_stats(self) -> dict:
+        """size and hit/miss counters of the answer cache"""
+        return self._cache.stats()
+
 
-resolver = AsyncResolver()
\ No newline at end of file
+resolver = AsyncResolver()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=resolver.reinit)
\ No newline at end of file